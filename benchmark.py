@@ -0,0 +1,215 @@
+#    Copyright (C) 2023 Nils Kronert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    https://github.com/NilsKr/JD08PatchManager
+
+# Times the main operations of the patch manager on synthetic .svd files (see
+# svdgenerator.py). Every run is appended to benchmark.json and compared with
+# the previous run (or --baseline), so regressions show up between versions.
+#
+# Usage: benchmark.py [--repeat N] [--label LABEL] [--baseline LABEL] [--output FILE] [--no-save]
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from patchlayout import PATCHDEF, getLayout
+from patchdiff import diffBanks, diffHashedSlots
+from patchdiffviewer import computeItems
+from svdfile import SvdFile, PATCH_COUNT
+from svdgenerator import generateSvd, generateVariant, writeSvd
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_FILE = os.path.join(BASE_DIR, "benchmark.json")
+REGRESSION_RATIO = 1.25 # Median slower than the baseline by more than this is reported
+
+# Files and state shared by the benchmarks
+class Context():
+    def __init__(self, directory):
+        self.layout = getLayout(os.path.join(BASE_DIR, PATCHDEF))
+        self.leftName = os.path.join(directory, "left.svd")
+        self.rightName = os.path.join(directory, "right.svd")
+        self.saveName = os.path.join(directory, "save.svd")
+        left = generateSvd(self.layout, 1)
+        writeSvd(self.leftName, left)
+        writeSvd(self.rightName, generateVariant(self.layout, left, 2))
+        writeSvd(self.saveName, left)
+        self.left = SvdFile(self.leftName)
+        self.right = SvdFile(self.rightName)
+        self.bankDiff = diffBanks(self.layout, self.left.getPatchArea(), self.right.getPatchArea())
+        self.diffSlot = next(i for i, d in enumerate(self.bankDiff) if d != None)
+
+# Each benchmark is (name, setup, run): setup prepares a repetition and is not
+# timed, run gets the result of setup.
+def setupNone(ctx):
+    return None
+
+def benchLoad(ctx, state):
+    SvdFile(ctx.leftName)
+
+def benchLoadMmap(ctx, state):
+    SvdFile(ctx.leftName, True).close()
+
+def setupModified(ctx):
+    svd = SvdFile(ctx.leftName)
+    svd.copyPatches(range(0, PATCH_COUNT, 16), ctx.right, range(0, PATCH_COUNT, 16))
+    return svd
+
+def benchLabels(ctx, svd):
+    [svd.getPatchLabel(index) for index in range(PATCH_COUNT)]
+
+def benchLabelsCompared(ctx, svd):
+    [svd.getPatchLabel(index, ctx.bankDiff[index]) for index in range(PATCH_COUNT)]
+
+def benchDiffSingle(ctx, state):
+    computeItems(ctx.layout, ctx.left.getPatch(ctx.diffSlot), ctx.right.getPatch(ctx.diffSlot), False, True, True)
+
+def benchDiffSingleChanges(ctx, state):
+    computeItems(ctx.layout, ctx.left.getPatch(ctx.diffSlot), ctx.right.getPatch(ctx.diffSlot), True, True, True)
+
+def benchDiffBank(ctx, state):
+    diffBanks(ctx.layout, ctx.left.getPatchArea(), ctx.right.getPatchArea())
+
+def benchDiffHashed(ctx, state):
+    diffHashedSlots(ctx.layout, ctx.left.getPatchHashes(), ctx.right.getPatchHashes(), ctx.left.getPatch, ctx.right.getPatch)
+
+def setupAllModified(ctx):
+    svd = SvdFile(ctx.leftName)
+    svd.copyPatches(range(PATCH_COUNT), ctx.right, range(PATCH_COUNT))
+    return svd
+
+def benchRevertAll(ctx, svd):
+    svd.revertAll()
+
+def setupSave(ctx):
+    svd = SvdFile(ctx.saveName)
+    svd.copyPatches(range(0, PATCH_COUNT, 32), ctx.right, range(0, PATCH_COUNT, 32))
+    return svd
+
+def benchSave(ctx, svd):
+    svd.save()
+
+BENCHMARKS = [
+    ("load", setupNone, benchLoad),
+    ("load mmap", setupNone, benchLoadMmap),
+    ("labels", setupModified, benchLabels),
+    ("labels compared", setupModified, benchLabelsCompared),
+    ("diff single", setupNone, benchDiffSingle),
+    ("diff single changes only", setupNone, benchDiffSingleChanges),
+    ("diff bank", setupNone, benchDiffBank),
+    ("diff bank hashed", setupNone, benchDiffHashed),
+    ("revert all", setupAllModified, benchRevertAll),
+    ("save", setupSave, benchSave),
+]
+
+def runBenchmarks(ctx, repeat):
+    results = {}
+    for name, setup, run in BENCHMARKS:
+        times = []
+        for i in range(repeat):
+            state = setup(ctx)
+            start = time.perf_counter()
+            run(ctx, state)
+            times.append((time.perf_counter() - start) * 1000)
+        results[name] = { "min": min(times), "median": statistics.median(times) }
+    return results
+
+def getLabel():
+    try:
+        result = subprocess.run(["git", "describe", "--always", "--dirty"], cwd=BASE_DIR,
+                                capture_output=True, text=True)
+        if result.returncode == 0:
+            return result.stdout.strip()
+    except OSError:
+        pass
+    return "unknown"
+
+def readResults(fileName):
+    if not os.path.exists(fileName):
+        return []
+    file = open(fileName, 'r')
+    runs = json.load(file)
+    file.close()
+    return runs
+
+def writeResults(fileName, runs):
+    tempName = fileName + ".tmp"
+    file = open(tempName, 'w')
+    json.dump(runs, file, indent=1)
+    file.close()
+    os.replace(tempName, fileName)
+
+def findBaseline(runs, label):
+    if label == None:
+        return runs[-1] if len(runs) > 0 else None
+    for run in reversed(runs):
+        if run["label"] == label:
+            return run
+    return None
+
+# Prints the results, returns the number of regressions compared with the baseline
+def report(results, baseline):
+    regressions = 0
+    if baseline != None:
+        print(f"Compared with {baseline['label']} ({baseline['date']})")
+    print(f"{'benchmark':<26}{'min ms':>10}{'median ms':>11}{'baseline':>10}{'ratio':>8}")
+    for name, result in results.items():
+        line = f"{name:<26}{result['min']:>10.3f}{result['median']:>11.3f}"
+        if baseline != None and name in baseline["results"]:
+            before = baseline["results"][name]["median"]
+            ratio = result["median"] / before if before > 0 else 1.0
+            line += f"{before:>10.3f}{ratio:>8.2f}"
+            if ratio > REGRESSION_RATIO:
+                line += "  REGRESSION"
+                regressions += 1
+        print(line)
+    return regressions
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmarks the patch manager on synthetic .svd files")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--label", help="name of this run (default: git describe)")
+    parser.add_argument("--baseline", help="label of the run to compare with (default: the previous run)")
+    parser.add_argument("--output", default=RESULTS_FILE)
+    parser.add_argument("--no-save", action="store_true", help="don't add the results to the output file")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        ctx = Context(directory)
+        results = runBenchmarks(ctx, args.repeat)
+        ctx.left.close()
+        ctx.right.close()
+
+    runs = readResults(args.output)
+    regressions = report(results, findBaseline(runs, args.baseline))
+    if not args.no_save:
+        runs.append({
+            "label": args.label if args.label != None else getLabel(),
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "repeat": args.repeat,
+            "results": results,
+        })
+        writeResults(args.output, runs)
+    return 1 if regressions > 0 else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
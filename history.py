@@ -0,0 +1,266 @@
+#    Copyright (C) 2023 Nils Kronert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    https://github.com/NilsKr/JD08PatchManager
+
+# Snapshot history of a .svd file, kept in the directory <file>.history next
+# to it. A snapshot stores the content hashes of the 256 patches and of the
+# rest of the file (the data before and after the patch section, in chunks of
+# CHUNK_SIZE), but only those that changed since the previous snapshot. The
+# patches and chunks themselves are stored once, zlib compressed, in an append
+# only pack file; history.json holds the snapshots and the position of every
+# object in the pack.
+#
+# Any snapshot can be written out as a complete file again, and single
+# patches of a snapshot can be read (e.g. to compare two snapshots in the
+# patch viewer) without reconstructing the file.
+#
+# Usage: history.py <file.svd> [--list] [--diff A B] [--restore N --output FILE]
+
+import argparse
+import datetime
+import json
+import os
+import sys
+import zlib
+import profiling
+from patchstore import hashPatch
+from svdfile import PATCH_COUNT, PATCH_SIZE, getPatchNumber
+
+HISTORY_SUFFIX = ".history"
+INDEX_FILE = "history.json"
+PACK_FILE = "objects.pack"
+HISTORY_VERSION = 1
+CHUNK_SIZE = 0x4000
+
+debug = profiling.getDebug("history")
+
+def getHistoryDirectory(fileName):
+    return fileName + HISTORY_SUFFIX
+
+# Full state of a snapshot, built by applying the changes of all snapshots up to it
+class Manifest():
+    def __init__(self):
+        self.size = 0
+        self.patchStart = 0
+        self.slots = [None] * PATCH_COUNT # Patch hashes
+        self.chunks = []                  # Hashes of the chunks before and after the patch section
+
+    def apply(self, snapshot):
+        self.size = snapshot["size"]
+        self.patchStart = snapshot["patchStart"]
+        for index, digest in snapshot["slots"].items():
+            self.slots[int(index)] = digest
+        del self.chunks[snapshot["chunkCount"]:]
+        self.chunks.extend([None] * (snapshot["chunkCount"] - len(self.chunks)))
+        for index, digest in snapshot["chunks"].items():
+            self.chunks[int(index)] = digest
+
+    def getRanges(self):
+        patchEnd = self.patchStart + PATCH_COUNT * PATCH_SIZE
+        return getChunkRanges(self.patchStart, patchEnd, self.size)
+
+# Returns the (start, end) of the chunks outside the patch section
+def getChunkRanges(patchStart, patchEnd, size):
+    ranges = []
+    for start, end in ((0, patchStart), (patchEnd, size)):
+        for offset in range(start, end, CHUNK_SIZE):
+            ranges.append((offset, min(offset + CHUNK_SIZE, end)))
+    return ranges
+
+class History():
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.directory = getHistoryDirectory(fileName)
+        self.objects = {}   # Hash -> [offset, length] in the pack file
+        self.snapshots = [] # Changes per snapshot, the first one holds everything
+        self.manifests = {} # Snapshot number -> Manifest, cache
+        self.load()
+
+    def __len__(self):
+        return len(self.snapshots)
+
+    def getIndexName(self):
+        return os.path.join(self.directory, INDEX_FILE)
+
+    def getPackName(self):
+        return os.path.join(self.directory, PACK_FILE)
+
+    def load(self):
+        if not os.path.exists(self.getIndexName()):
+            return
+        file = open(self.getIndexName(), 'r')
+        data = json.load(file)
+        file.close()
+        if data.get("version") != HISTORY_VERSION:
+            raise ValueError(f"Unsupported history version in {self.getIndexName()}")
+        self.objects = data["objects"]
+        self.snapshots = data["snapshots"]
+
+    def writeIndex(self):
+        tempName = self.getIndexName() + ".tmp"
+        file = open(tempName, 'w')
+        json.dump({ "version": HISTORY_VERSION, "objects": self.objects, "snapshots": self.snapshots }, file,
+                  separators=(",", ":"))
+        file.flush()
+        os.fsync(file.fileno())
+        file.close()
+        os.replace(tempName, self.getIndexName())
+
+    # Snapshots are numbered from 1
+    def getManifest(self, number):
+        manifest = self.manifests.get(number)
+        if manifest == None:
+            if number < 1 or number > len(self.snapshots):
+                raise IndexError(f"Snapshot {number} does not exist")
+            manifest = Manifest()
+            for snapshot in self.snapshots[0:number]:
+                manifest.apply(snapshot)
+            self.manifests[number] = manifest
+        return manifest
+
+    def readObject(self, digest, pack = None):
+        offset, length = self.objects[digest]
+        if pack == None:
+            file = open(self.getPackName(), 'rb')
+            file.seek(offset)
+            data = file.read(length)
+            file.close()
+        else:
+            pack.seek(offset)
+            data = pack.read(length)
+        return zlib.decompress(data)
+
+    # Adds a snapshot of the file contents (e.g. SvdFile.orig after saving).
+    # Returns the snapshot number, or None if nothing changed since the last one.
+    def record(self, data, patchStart, label = ""):
+        with profiling.span("history record"):
+            size = len(data)
+            patchEnd = patchStart + PATCH_COUNT * PATCH_SIZE
+            data = memoryview(data)
+            slots = [hashPatch(data[patchStart + i * PATCH_SIZE:patchStart + (i + 1) * PATCH_SIZE])
+                     for i in range(PATCH_COUNT)]
+            ranges = getChunkRanges(patchStart, patchEnd, size)
+            chunks = [hashPatch(data[start:end]) for start, end in ranges]
+
+            if len(self.snapshots) > 0:
+                previous = self.getManifest(len(self.snapshots))
+            else:
+                previous = Manifest()
+            changedSlots = { str(i): d for i, d in enumerate(slots) if d != previous.slots[i] }
+            changedChunks = { str(i): d for i, d in enumerate(chunks) if i >= len(previous.chunks) or d != previous.chunks[i] }
+            if len(changedSlots) == 0 and len(changedChunks) == 0 and size == previous.size and patchStart == previous.patchStart:
+                return None
+
+            # Store the new objects first, an interrupted save leaves unused data in the pack only
+            os.makedirs(self.directory, exist_ok=True)
+            pack = open(self.getPackName(), 'ab')
+            offset = pack.seek(0, os.SEEK_END)
+            for index, digest in changedSlots.items():
+                start = patchStart + int(index) * PATCH_SIZE
+                offset = self.storeObject(pack, offset, digest, data[start:start + PATCH_SIZE])
+            for index, digest in changedChunks.items():
+                start, end = ranges[int(index)]
+                offset = self.storeObject(pack, offset, digest, data[start:end])
+            pack.flush()
+            os.fsync(pack.fileno())
+            pack.close()
+
+            self.snapshots.append({
+                "date": datetime.datetime.now().isoformat(timespec="seconds"),
+                "label": label,
+                "size": size,
+                "patchStart": patchStart,
+                "chunkCount": len(chunks),
+                "slots": changedSlots,
+                "chunks": changedChunks,
+            })
+            self.writeIndex()
+            debug(f"Snapshot {len(self.snapshots)}: {len(changedSlots)} patches, {len(changedChunks)} chunks changed")
+            return len(self.snapshots)
+
+    def storeObject(self, pack, offset, digest, data):
+        if digest in self.objects:
+            return offset
+        compressed = zlib.compress(data)
+        pack.write(compressed)
+        self.objects[digest] = [offset, len(compressed)]
+        return offset + len(compressed)
+
+    def getPatch(self, number, index):
+        return self.readObject(self.getManifest(number).slots[index])
+
+    def getPatchHashes(self, number):
+        return list(self.getManifest(number).slots)
+
+    # Slots whose patches differ between two snapshots, compared by hash
+    def changedSlots(self, first, second):
+        left = self.getManifest(first).slots
+        right = self.getManifest(second).slots
+        return [i for i in range(PATCH_COUNT) if left[i] != right[i]]
+
+    # Writes the complete file of a snapshot, one object at a time
+    def restore(self, number, fileName):
+        manifest = self.getManifest(number)
+        ranges = manifest.getRanges()
+        pack = open(self.getPackName(), 'rb')
+        tempName = fileName + ".tmp"
+        file = open(tempName, 'wb')
+        patchEnd = manifest.patchStart + PATCH_COUNT * PATCH_SIZE
+        for (start, end), digest in zip(ranges, manifest.chunks):
+            if start == patchEnd:
+                self.writePatches(file, manifest, pack)
+            file.write(self.readObject(digest, pack))
+        if file.tell() == manifest.patchStart: # Nothing follows the patch section
+            self.writePatches(file, manifest, pack)
+        file.flush()
+        os.fsync(file.fileno())
+        file.close()
+        pack.close()
+        os.replace(tempName, fileName)
+
+    def writePatches(self, file, manifest, pack):
+        for digest in manifest.slots:
+            file.write(self.readObject(digest, pack))
+
+def describe(history, number):
+    snapshot = history.snapshots[number - 1]
+    label = " " + snapshot["label"] if snapshot["label"] != "" else ""
+    return f"{number:>4} {snapshot['date']}{label}: {len(snapshot['slots'])} patches, {len(snapshot['chunks'])} chunks changed"
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Shows and restores the snapshot history of a .svd file")
+    parser.add_argument("fileName")
+    parser.add_argument("--list", action="store_true", help="list the snapshots")
+    parser.add_argument("--diff", nargs=2, type=int, metavar=("A", "B"), help="list the patches that differ between two snapshots")
+    parser.add_argument("--restore", type=int, metavar="N", help="write snapshot N to --output")
+    parser.add_argument("--output", help="file name for --restore")
+    args = parser.parse_args(argv)
+
+    history = History(args.fileName)
+    if args.list or (args.diff == None and args.restore == None):
+        for number in range(1, len(history) + 1):
+            print(describe(history, number))
+    if args.diff != None:
+        first, second = args.diff
+        for index in history.changedSlots(first, second):
+            print(f"{getPatchNumber(index)}")
+    if args.restore != None:
+        if args.output == None:
+            parser.error("--restore requires --output")
+        history.restore(args.restore, args.output)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
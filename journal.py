@@ -0,0 +1,149 @@
+#    Copyright (C) 2023 Nils Kronert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    https://github.com/NilsKr/JD08PatchManager
+
+# Undo/redo history of patch edits. Every edit is stored as a delta holding the
+# slot index and the old and new bytes of the changed range only (a full patch
+# for copies, the name for renames), so undoing never touches other slots.
+
+import time
+
+DEFAULT_BUDGET = 2 * 1024 * 1024 # Bytes of old/new data kept in the history
+COALESCE_SECONDS = 1.0
+
+class Delta():
+    def __init__(self, index, offset, old, new):
+        self.index = index
+        self.offset = offset
+        self.old = old
+        self.new = new
+
+    def __repr__(self):
+        return f"slot {self.index} @{self.offset} {len(self.new)} bytes"
+
+    def size(self):
+        return len(self.old) + len(self.new)
+
+class Step():
+    def __init__(self):
+        self.deltas = []
+        self.time = time.monotonic()
+        self.size = 0
+
+    def add(self, delta):
+        self.deltas.append(delta)
+        self.size += delta.size()
+
+    def slots(self):
+        return sorted(set(d.index for d in self.deltas))
+
+class Journal():
+    def __init__(self, budget = DEFAULT_BUDGET):
+        self.budget = budget
+        self.undoSteps = []
+        self.redoSteps = []
+        self.size = 0
+        self.group = None
+        self.groupLevel = 0
+
+    def clear(self):
+        self.undoSteps = []
+        self.redoSteps = []
+        self.size = 0
+
+    def canUndo(self):
+        return len(self.undoSteps) > 0
+
+    def canRedo(self):
+        return len(self.redoSteps) > 0
+
+    # Edits recorded between beginGroup and endGroup are undone as one step
+    def beginGroup(self):
+        if self.groupLevel == 0:
+            self.group = Step()
+        self.groupLevel += 1
+
+    def endGroup(self):
+        self.groupLevel -= 1
+        if self.groupLevel == 0:
+            group = self.group
+            self.group = None
+            if len(group.deltas) > 0:
+                self.push(group)
+
+    def record(self, index, offset, old, new):
+        if old == new:
+            return
+        delta = Delta(index, offset, bytes(old), bytes(new))
+        if self.group != None:
+            self.group.add(delta)
+            return
+        if self.coalesce(delta):
+            return
+        step = Step()
+        step.add(delta)
+        self.push(step)
+
+    # Repeated edits of the same range of a slot in quick succession (e.g. renaming
+    # a patch twice) are merged into the previous step.
+    def coalesce(self, delta):
+        if len(self.undoSteps) == 0 or len(self.redoSteps) > 0:
+            return False
+        last = self.undoSteps[-1]
+        if len(last.deltas) != 1 or time.monotonic() - last.time > COALESCE_SECONDS:
+            return False
+        previous = last.deltas[0]
+        if previous.index != delta.index or previous.offset != delta.offset or len(previous.new) != len(delta.new):
+            return False
+        self.size -= last.size
+        merged = Delta(delta.index, delta.offset, previous.old, delta.new)
+        last.deltas = []
+        last.size = 0
+        last.time = time.monotonic()
+        if merged.old == merged.new: # Back where we started
+            self.undoSteps.pop()
+        else:
+            last.add(merged)
+            self.size += last.size
+        return True
+
+    def push(self, step):
+        self.undoSteps.append(step)
+        self.size += step.size
+        for redo in self.redoSteps:
+            self.size -= redo.size
+        self.redoSteps = []
+        self.trim()
+
+    def trim(self):
+        while self.size > self.budget and len(self.undoSteps) > 1:
+            self.size -= self.undoSteps.pop(0).size
+
+    # Returns the step to undo, the caller applies the old data of its deltas in reverse order
+    def popUndo(self):
+        if len(self.undoSteps) == 0:
+            return None
+        step = self.undoSteps.pop()
+        self.redoSteps.append(step)
+        return step
+
+    # Returns the step to redo, the caller applies the new data of its deltas in order
+    def popRedo(self):
+        if len(self.redoSteps) == 0:
+            return None
+        step = self.redoSteps.pop()
+        self.undoSteps.append(step)
+        return step
@@ -0,0 +1,177 @@
+#    Copyright (C) 2023 Nils Kronert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    https://github.com/NilsKr/JD08PatchManager
+
+# Scans directory trees of .svd backups into a persistent library index with
+# the model (JD-08/JX-08), the 256 patch names and the per slot content hashes
+# of every file. Files are validated and read by SvdFile in a process pool.
+# A file is only scanned again when its size or modification time changed, so
+# rescanning an unchanged library just stats the files.
+#
+# Usage: library.py <directory> [...] [--index FILE] [--jobs N] [--find NAME] [--hash HASH]
+
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import profiling
+from svdfile import SvdFile, SvdError, PATCH_COUNT, getPatchNumber
+
+LIBRARY_FILE = "library.json"
+LIBRARY_VERSION = 1
+SVD_EXTENSION = ".svd"
+MIN_PARALLEL_FILES = 4 # Fewer files are scanned without starting worker processes
+
+debug = profiling.getDebug("library")
+
+# Reads one .svd file, runs in a worker process
+def scanFile(fileName):
+    entry = { "size": -1, "mtime": -1 } # Scanned again next time if the file cannot be read
+    try:
+        stat = os.stat(fileName)
+        entry = { "size": stat.st_size, "mtime": stat.st_mtime_ns }
+        svd = SvdFile(fileName, True)
+    except (SvdError, OSError) as e:
+        entry["error"] = str(e)
+        return entry
+    try:
+        entry["model"] = svd.getModel()
+        entry["names"] = [svd.getPatchName(i) for i in range(PATCH_COUNT)]
+        entry["hashes"] = [svd.getPatchHash(i) for i in range(PATCH_COUNT)]
+    except ValueError as e: # E.g. a patch name that is not valid UTF-8
+        entry = { "size": stat.st_size, "mtime": stat.st_mtime_ns, "error": str(e) }
+    svd.close()
+    return entry
+
+def findSvdFiles(directory):
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith(SVD_EXTENSION):
+                yield os.path.abspath(os.path.join(root, name))
+
+class Library():
+    def __init__(self, fileName = LIBRARY_FILE):
+        self.fileName = fileName
+        self.files = {} # Absolute file name -> entry of scanFile
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.fileName):
+            return
+        try:
+            file = open(self.fileName, 'r')
+            data = json.load(file)
+            file.close()
+        except (OSError, ValueError) as e:
+            print(f"Cannot read library index {self.fileName}: {e}")
+            return
+        if data.get("version") == LIBRARY_VERSION:
+            self.files = data["files"]
+
+    def save(self):
+        tempName = self.fileName + ".tmp"
+        file = open(tempName, 'w')
+        json.dump({ "version": LIBRARY_VERSION, "files": self.files }, file, separators=(",", ":"))
+        file.close()
+        os.replace(tempName, self.fileName)
+
+    # Updates the index with the .svd files below the directories, returns the
+    # number of files that were (re)scanned
+    def scan(self, directories, jobs = None):
+        with profiling.span("library scan"):
+            found = {}
+            for directory in directories:
+                for fileName in findSvdFiles(directory):
+                    try:
+                        found[fileName] = os.stat(fileName)
+                    except OSError: # Removed while scanning
+                        pass
+            # Forget the files that were removed from the scanned directories
+            prefixes = tuple(os.path.join(os.path.abspath(d), "") for d in directories)
+            for fileName in list(self.files):
+                if fileName.startswith(prefixes) and not fileName in found:
+                    del self.files[fileName]
+            changed = []
+            for fileName, stat in found.items():
+                entry = self.files.get(fileName)
+                if entry == None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime_ns:
+                    changed.append(fileName)
+            debug(f"{len(found)} files, {len(changed)} to scan")
+
+            if len(changed) < MIN_PARALLEL_FILES or jobs == 1:
+                entries = map(scanFile, changed)
+                for fileName, entry in zip(changed, entries):
+                    self.files[fileName] = entry
+            else:
+                with ProcessPoolExecutor(max_workers=jobs) as pool:
+                    for fileName, entry in zip(changed, pool.map(scanFile, changed, chunksize=4)):
+                        self.files[fileName] = entry
+            return len(changed)
+
+    # Returns (file name, slot, patch name) of the patches whose name contains text
+    def findName(self, text):
+        text = text.lower()
+        result = []
+        for fileName, entry in sorted(self.files.items()):
+            for index, name in enumerate(entry.get("names", [])):
+                if text in name.lower():
+                    result.append((fileName, index, name))
+        return result
+
+    # Returns (file name, slot, patch name) of the patches with the content hash
+    def findHash(self, digest):
+        result = []
+        for fileName, entry in sorted(self.files.items()):
+            for index, patchHash in enumerate(entry.get("hashes", [])):
+                if patchHash == digest:
+                    result.append((fileName, index, entry["names"][index]))
+        return result
+
+def printPatches(patches):
+    for fileName, index, name in patches:
+        print(f"{fileName} {getPatchNumber(index)} {name}")
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Scans directories of JD-08/JX-08 .svd backups into a library index")
+    parser.add_argument("directories", nargs="*")
+    parser.add_argument("--index", default=LIBRARY_FILE, help="library index file (default: library.json)")
+    parser.add_argument("--jobs", type=int, help="number of worker processes (default: one per CPU)")
+    parser.add_argument("--find", help="list the patches whose name contains this text")
+    parser.add_argument("--hash", help="list the patches with this content hash")
+    args = parser.parse_args(argv)
+
+    library = Library(args.index)
+    if len(args.directories) > 0:
+        scanned = library.scan(args.directories, args.jobs)
+        library.save()
+        models = {}
+        for entry in library.files.values():
+            model = entry.get("model") if not "error" in entry else "invalid"
+            models[model] = models.get(model, 0) + 1
+        summary = ", ".join(f"{count} {model if model != None else 'unknown model'}" for model, count in models.items())
+        print(f"{len(library.files)} files ({summary}), {scanned} scanned")
+        for fileName, entry in sorted(library.files.items()):
+            if "error" in entry:
+                print(f"{fileName}: {entry['error']}")
+    if args.find != None:
+        printPatches(library.findName(args.find))
+    if args.hash != None:
+        printPatches(library.findHash(args.hash))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,139 @@
+#    Copyright (C) 2023 Nils Kronert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    https://github.com/NilsKr/JD08PatchManager
+
+# Three-way merge of .svd files: two copies (ours and theirs) that were both
+# edited starting from the same base file. Every slot is classified by the
+# content hashes of its three patches, so only conflicting slots are ever
+# decoded (for the field detail). The patches that only theirs changed are
+# copied into ours in one undoable operation; ours keeps its own changes and
+# the conflicts are left to the user.
+#
+# Usage: merge.py <base.svd> <ours.svd> <theirs.svd> [--output FILE] [--detail]
+
+import argparse
+import os
+import sys
+import profiling
+from svdfile import SvdFile, SvdError, getPatchNumber
+
+UNCHANGED = "unchanged" # Equal in all three files
+OURS      = "ours"      # Only changed in ours
+THEIRS    = "theirs"    # Only changed in theirs
+BOTH      = "both"      # Changed identically in both
+CONFLICT  = "conflict"  # Changed differently in both
+
+debug = profiling.getDebug("merge")
+
+def classifySlots(baseHashes, ourHashes, theirHashes):
+    states = []
+    for base, ours, theirs in zip(baseHashes, ourHashes, theirHashes):
+        if ours == theirs:
+            states.append(UNCHANGED if ours == base else BOTH)
+        elif ours == base:
+            states.append(THEIRS)
+        elif theirs == base:
+            states.append(OURS)
+        else:
+            states.append(CONFLICT)
+    return states
+
+# Fields of a conflicting slot changed by either side
+class SlotConflict():
+    def __init__(self, slot, ourFields, theirFields):
+        self.slot = slot
+        self.ourFields = ourFields
+        self.theirFields = theirFields
+
+    def __repr__(self):
+        return f"slot {self.slot}: ours {len(self.ourFields)} fields, theirs {len(self.theirFields)} fields, " + \
+               f"{len(self.getOverlap())} in both"
+
+    # Fields changed by both sides, the real conflicts
+    def getOverlap(self):
+        theirs = set(f.index for f in self.theirFields)
+        return [f for f in self.ourFields if f.index in theirs]
+
+class Merge():
+    def __init__(self, base, ours, theirs):
+        self.base = base
+        self.ours = ours
+        self.theirs = theirs
+        with profiling.span("merge classify"):
+            self.states = classifySlots(base.getPatchHashes(), ours.getPatchHashes(), theirs.getPatchHashes())
+
+    def getSlots(self, state):
+        return [slot for slot, s in enumerate(self.states) if s == state]
+
+    def getConflicts(self):
+        return self.getSlots(CONFLICT)
+
+    def count(self, state):
+        return self.states.count(state)
+
+    # Copies the patches only theirs changed into ours, returns the slots
+    def apply(self):
+        slots = self.getSlots(THEIRS)
+        with profiling.span("merge apply"):
+            self.ours.copyPatches(slots, self.theirs, slots)
+        debug(f"{len(slots)} patches merged, {self.count(CONFLICT)} conflicts")
+        return slots
+
+    # Compares both sides of a slot with the base, field by field
+    def getConflict(self, layout, slot):
+        from patchdiff import changedFields
+        basePatch = self.base.getPatch(slot)
+        return SlotConflict(slot, changedFields(layout, basePatch, self.ours.getPatch(slot)),
+                            changedFields(layout, basePatch, self.theirs.getPatch(slot)))
+
+def describeConflict(conflict):
+    overlap = conflict.getOverlap()
+    text = f"ours {len(conflict.ourFields)} fields, theirs {len(conflict.theirFields)} fields"
+    if len(overlap) > 0:
+        text += ", both: " + ", ".join(f.path for f in overlap)
+    return text
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Merges two edited copies of a .svd file")
+    parser.add_argument("base", help="the file both copies started from")
+    parser.add_argument("ours")
+    parser.add_argument("theirs")
+    parser.add_argument("--output", help="write the merged file (ours with the changes of theirs)")
+    parser.add_argument("--detail", action="store_true", help="list the changed fields of the conflicts")
+    args = parser.parse_args(argv)
+
+    try:
+        files = [SvdFile(name) for name in (args.base, args.ours, args.theirs)]
+    except (SvdError, OSError) as e:
+        print(e)
+        return 1
+    merge = Merge(*files)
+    print(", ".join(f"{merge.count(state)} {state}" for state in (UNCHANGED, OURS, THEIRS, BOTH, CONFLICT)))
+    if args.detail:
+        from patchlayout import PATCHDEF, getLayout
+        layout = getLayout(os.path.join(os.path.dirname(os.path.abspath(__file__)), PATCHDEF))
+    for slot in merge.getConflicts():
+        line = f"{getPatchNumber(slot)} {merge.ours.getPatchName(slot)} / {merge.theirs.getPatchName(slot)}"
+        if args.detail:
+            line += ": " + describeConflict(merge.getConflict(layout, slot))
+        print(line)
+    if args.output != None:
+        merge.apply()
+        merge.ours.save(args.output)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,232 @@
+#    Copyright (C) 2023 Nils Kronert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    https://github.com/NilsKr/JD08PatchManager
+
+# Patch bundles (.jdp): one or more patches exported from a .svd file, to be
+# imported into any slots of another one. A bundle is
+#
+#   header   magic "JDPB", version, flags, patch count, model (16 bytes)
+#   table    per patch its content hash and name (32 bytes each)
+#   patches  the 0x800 byte patches, as one zlib stream if FLAG_ZLIB is set
+#
+# so the contents can be listed from the table alone. Bundles are written and
+# read a patch at a time, and every patch is checked against its hash.
+#
+# Usage: patchbundle.py list <bundle.jdp>
+#        patchbundle.py export <file.svd> <bundle.jdp> [--slots A1:1-A8:8] [--no-compress]
+#        patchbundle.py import <bundle.jdp> <file.svd> [--to A1:1] [--output FILE]
+
+import argparse
+import os
+import struct
+import sys
+import zlib
+import profiling
+from patchstore import hashPatch
+from svdfile import SvdFile, SvdError, PATCH_COUNT, PATCH_SIZE, PATCH_NAME_OFFSET, PATCH_NAME_LENGTH, \
+                    getPatchNumber, parsePatchNumber
+
+BUNDLE_EXTENSION = ".jdp"
+BUNDLE_MAGIC = b"JDPB"
+BUNDLE_VERSION = 1
+FLAG_ZLIB = 1
+HEADER = struct.Struct("<4sBBH8s") # Magic, version, flags, count, model
+ENTRY = struct.Struct("<16s16s")    # Content hash, name
+READ_SIZE = 0x10000
+
+debug = profiling.getDebug("patchbundle")
+
+class BundleError(Exception):
+    pass
+
+# The patches of a bundle. Like SvdFile it has getPatch and getPatchArea, so
+# SvdFile.copyPatches imports from it.
+class Bundle():
+    def __init__(self, model = None):
+        self.model = model
+        self.names = []
+        self.hashes = []
+        self.patches = []
+
+    def __len__(self):
+        return len(self.patches)
+
+    def getModel(self):
+        return self.model
+
+    def getPatch(self, index):
+        return memoryview(self.patches[index])
+
+    def getPatchArea(self):
+        return memoryview(b"".join(self.patches))
+
+    def getPatchName(self, index):
+        return self.names[index]
+
+    def getPatchHash(self, index):
+        return self.hashes[index]
+
+def encodeName(patch):
+    return bytes(patch[PATCH_NAME_OFFSET:PATCH_NAME_OFFSET + PATCH_NAME_LENGTH])
+
+# Writes the patches (buffers of PATCH_SIZE bytes) to a file object
+def writeBundle(file, patches, model = None, compress = True):
+    with profiling.span("bundle write"):
+        if len(patches) > 0xFFFF:
+            raise BundleError("Too many patches for one bundle")
+        modelName = (model if model != None else "").encode()[0:8]
+        file.write(HEADER.pack(BUNDLE_MAGIC, BUNDLE_VERSION, FLAG_ZLIB if compress else 0, len(patches), modelName))
+        for patch in patches:
+            if len(patch) != PATCH_SIZE:
+                raise BundleError(f"A patch has {len(patch)} bytes instead of {PATCH_SIZE}")
+            file.write(ENTRY.pack(bytes.fromhex(hashPatch(patch)), encodeName(patch)))
+        compressor = zlib.compressobj() if compress else None
+        for patch in patches:
+            file.write(compressor.compress(patch) if compressor != None else patch)
+        if compressor != None:
+            file.write(compressor.flush())
+
+# Reads the header and the table and yields (model, count), then yields the
+# patches one at a time as (name, hash, patch)
+def iterBundle(file):
+    header = file.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise BundleError("Not a patch bundle")
+    magic, version, flags, count, modelName = HEADER.unpack(header)
+    if magic != BUNDLE_MAGIC:
+        raise BundleError("Not a patch bundle")
+    if version != BUNDLE_VERSION:
+        raise BundleError(f"Unsupported patch bundle version {version}")
+    table = file.read(count * ENTRY.size)
+    if len(table) < count * ENTRY.size:
+        raise BundleError("The patch bundle is truncated")
+    entries = list(ENTRY.iter_unpack(table))
+    yield modelName.rstrip(b"\0").decode() or None, count
+
+    decompressor = zlib.decompressobj() if flags & FLAG_ZLIB else None
+    buffer = bytearray()
+    for digest, name in entries:
+        while len(buffer) < PATCH_SIZE:
+            data = file.read(READ_SIZE)
+            if len(data) == 0:
+                if decompressor != None:
+                    buffer += decompressor.flush()
+                if len(buffer) < PATCH_SIZE:
+                    raise BundleError("The patch bundle is truncated")
+                break
+            buffer += decompressor.decompress(data) if decompressor != None else data
+        patch = bytes(buffer[0:PATCH_SIZE])
+        del buffer[0:PATCH_SIZE]
+        if hashPatch(patch) != digest.hex():
+            raise BundleError("The patch bundle is damaged (hash mismatch)")
+        yield name.decode("UTF-8", "replace").strip(), digest.hex(), patch
+
+def readBundle(fileName):
+    with profiling.span("bundle read"):
+        file = open(fileName, 'rb')
+        try:
+            entries = iterBundle(file)
+            model, count = next(entries)
+            bundle = Bundle(model)
+            for name, digest, patch in entries:
+                bundle.names.append(name)
+                bundle.hashes.append(digest)
+                bundle.patches.append(patch)
+        except (zlib.error, struct.error, ValueError) as e: # ValueError includes UnicodeDecodeError
+            raise BundleError(f"The patch bundle is damaged ({e})")
+        finally:
+            file.close()
+        debug(f"{fileName}: {len(bundle)} patches")
+        return bundle
+
+# Exports the patches in the given slots of an SvdFile, the file is replaced
+# only when complete
+def exportPatches(svd, slots, fileName, compress = True):
+    tempName = fileName + ".tmp"
+    file = open(tempName, 'wb')
+    try:
+        writeBundle(file, [svd.getPatch(i) for i in slots], svd.getModel(), compress)
+        file.close()
+    except:
+        file.close()
+        os.remove(tempName)
+        raise
+    os.replace(tempName, fileName)
+
+# Imports the first len(toIndices) patches of the bundle as one undo step
+def importPatches(svd, toIndices, bundle):
+    if len(toIndices) > len(bundle):
+        raise BundleError(f"The bundle holds {len(bundle)} patches, not {len(toIndices)}")
+    with profiling.span("bundle import"):
+        svd.copyPatches(list(toIndices), bundle, list(range(len(toIndices))))
+
+# Parses "A1:1" or a range "A1:1-A2:8" into a list of slots
+def parseSlots(text):
+    slots = []
+    for part in text.split(","):
+        first, _, last = part.strip().partition("-")
+        start = parsePatchNumber(first)
+        end = parsePatchNumber(last) if last != "" else start
+        slots.extend(range(start, end + 1))
+    return slots
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Exports and imports JD-08/JX-08 patch bundles")
+    commands = parser.add_subparsers(dest="command", required=True)
+    listCommand = commands.add_parser("list", help="list the patches of a bundle")
+    listCommand.add_argument("bundle")
+    exportCommand = commands.add_parser("export", help="export patches of a .svd file")
+    exportCommand.add_argument("svd")
+    exportCommand.add_argument("bundle")
+    exportCommand.add_argument("--slots", default="A1:1-D8:8", help="slots to export, e.g. A1:1-A2:8,C3:1 (default: all)")
+    exportCommand.add_argument("--no-compress", action="store_true")
+    importCommand = commands.add_parser("import", help="import a bundle into consecutive slots of a .svd file")
+    importCommand.add_argument("bundle")
+    importCommand.add_argument("svd")
+    importCommand.add_argument("--to", default="A1:1", help="first slot (default: A1:1)")
+    importCommand.add_argument("--output", help="save to this file instead of the .svd file")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "list":
+            bundle = readBundle(args.bundle)
+            print(f"{len(bundle)} patches{', ' + bundle.model if bundle.model != None else ''}")
+            for index in range(len(bundle)):
+                print(f"{index + 1:>4} {bundle.getPatchHash(index)} {bundle.getPatchName(index)}")
+        elif args.command == "export":
+            svd = SvdFile(args.svd, True)
+            slots = parseSlots(args.slots)
+            exportPatches(svd, slots, args.bundle, not args.no_compress)
+            svd.close()
+            print(f"{len(slots)} patches exported")
+        else:
+            bundle = readBundle(args.bundle)
+            svd = SvdFile(args.svd)
+            start = parsePatchNumber(args.to)
+            slots = list(range(start, min(start + len(bundle), PATCH_COUNT)))
+            if svd.getModel() != bundle.model and bundle.model != None:
+                print(f"Warning: importing {bundle.model} patches into a {svd.getModel()} file")
+            importPatches(svd, slots, bundle)
+            svd.save(args.output)
+            if len(slots) > 0:
+                print(f"{len(slots)} patches imported to {getPatchNumber(slots[0])}..{getPatchNumber(slots[-1])}")
+    except (BundleError, SvdError, OSError, ValueError) as e:
+        print(e)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
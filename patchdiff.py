@@ -0,0 +1,133 @@
+#    Copyright (C) 2023 Nils Kronert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    https://github.com/NilsKr/JD08PatchManager
+
+# Byte level comparison of patches. The buffers are compared in bulk first and
+# only the differing byte ranges are mapped to fields of the patch layout, so
+# patches that differ in a few bytes never need a full decode.
+
+import re
+
+NONZERO_RUN = re.compile(rb"[^\x00]+")
+
+# Returns the differing byte ranges of two buffers as a list of (start, end) tuples
+def diffRanges(left, right):
+    n = min(len(left), len(right))
+    left = memoryview(left)[:n]
+    right = memoryview(right)[:n]
+    if left == right:
+        return []
+    # XOR both buffers as big integers, the differing bytes are the non-zero ones
+    xor = (int.from_bytes(left, "little") ^ int.from_bytes(right, "little")).to_bytes(n, "little")
+    return [m.span() for m in NONZERO_RUN.finditer(xor)]
+
+# Returns the layout fields covered by the given byte ranges, in layout order
+def fieldsInRanges(layout, ranges):
+    result = []
+    lastIndex = -1
+    for start, end in ranges:
+        for field in layout.fieldsInRange(start, end):
+            if field.index > lastIndex: # Ranges may share a field (e.g. both bytes of a uint16le)
+                result.append(field)
+                lastIndex = field.index
+    return result
+
+# Returns the layout fields whose bytes differ, in layout order
+def changedFields(layout, left, right):
+    return fieldsInRanges(layout, diffRanges(left, right))
+
+SLOT_SIZE = 0x800
+SLOT_COUNT = 256
+
+SECTION_COMMON      = "common"
+SECTION_TONE        = "tone"
+SECTION_EFFECTS     = "effects"
+SECTION_PRECOMPUTED = "precomputed"
+SECTIONS = [SECTION_COMMON, SECTION_TONE, SECTION_EFFECTS, SECTION_PRECOMPUTED]
+
+# Top level PatchVST fields that are not part of the common section
+SECTION_FIELDS = { "tone": SECTION_TONE, "effectsGroupA": SECTION_EFFECTS, "effectsGroupB": SECTION_EFFECTS }
+
+_fieldSections = {}
+
+def getFieldSections(layout):
+    sections = _fieldSections.get(id(layout))
+    if sections == None:
+        sections = {}
+        for field in layout.fields:
+            if field.isPrecomputed():
+                sections[field.index] = SECTION_PRECOMPUTED
+                continue
+            top = field
+            while top.depth > 1:
+                top = layout.parentOf(top)
+            name = top.name
+            p = name.find("[")
+            if p > -1:
+                name = name[:p]
+            sections[field.index] = SECTION_FIELDS.get(name, SECTION_COMMON)
+        _fieldSections[id(layout)] = sections
+    return sections
+
+class SlotDiff():
+    def __init__(self, slot, fields, sections):
+        self.slot = slot
+        self.fields = fields        # Changed layout fields
+        self.sections = sections    # Changed sections, in the order of SECTIONS
+
+    def __repr__(self):
+        return f"slot {self.slot}: {len(self.fields)} fields ({', '.join(self.sections)})"
+
+    def fieldCount(self):
+        return len(self.fields)
+
+def makeSlotDiff(layout, slot, ranges):
+    fields = fieldsInRanges(layout, ranges)
+    fieldSections = getFieldSections(layout)
+    changed = set(fieldSections[f.index] for f in fields)
+    return SlotDiff(slot, fields, [s for s in SECTIONS if s in changed])
+
+# Compares a single slot, returns None if both patches are equal
+def diffSlot(layout, slot, left, right):
+    ranges = diffRanges(left, right)
+    if len(ranges) == 0:
+        return None
+    return makeSlotDiff(layout, slot, ranges)
+
+# Compares all slots of two patch sections in one pass. left and right are the
+# patch areas (slotCount * slotSize bytes) of both files. Returns a list with a
+# SlotDiff per slot, or None where the slots are equal.
+def diffBanks(layout, left, right, slotCount = SLOT_COUNT, slotSize = SLOT_SIZE):
+    result = [None] * slotCount
+    slotRanges = {}
+    for start, end in diffRanges(left, right):
+        while start < end: # Split ranges crossing slot boundaries
+            slot = start // slotSize
+            if slot >= slotCount:
+                break
+            base = slot * slotSize
+            slotEnd = min(end, base + slotSize)
+            slotRanges.setdefault(slot, []).append((start - base, slotEnd - base))
+            start = slotEnd
+    for slot, ranges in slotRanges.items():
+        result[slot] = makeSlotDiff(layout, slot, ranges)
+    return result
+
+# Like diffBanks, but only the slots whose content hashes differ are compared.
+# getLeft and getRight return the patch of a slot.
+def diffHashedSlots(layout, leftHashes, rightHashes, getLeft, getRight):
+    return [None if leftHash == rightHash else diffSlot(layout, slot, getLeft(slot), getRight(slot))
+            for slot, (leftHash, rightHash) in enumerate(zip(leftHashes, rightHashes))]
@@ -24,43 +24,118 @@
 
 import tkinter as tk
 import tkinter.font as tkFont
-import sys
-import os
+import threading
+import time
+import profiling
 
 from tkinter import *
 from tkinter import ttk
 from tkinter import Frame 
-from preferences import Preferences
+from patchlayout import PATCHDEF, getLayout
+from patchdiff import changedFields
+
+debug = profiling.getDebug("patchdiffviewer")
+
+NOTHING_TO_SHOW = ("nothing", "", "Nothing to show", ("n.a.", "n.a."))
+
+def errorItem(error):
+    return ("error", "", f"Cannot show patches: {error}", ("n.a.", "n.a."))
+
+DEBOUNCE_SECONDS = 0.05 # Requests arriving faster than this (e.g. key repeat) are merged
+POLL_MS = 20
+
+# Computes the tree items in a background thread. Only the latest request is
+# computed, once no newer request has arrived for DEBOUNCE_SECONDS.
+class DiffWorker():
+    def __init__(self, compute):
+        self.compute = compute
+        self.condition = threading.Condition()
+        self.request = None # (generation, arguments)
+        self.requestTime = 0
+        self.result = None  # (generation, result or exception)
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name="DiffWorker", daemon=True)
+        self.thread.start()
+
+    def submit(self, generation, *args):
+        with self.condition:
+            self.request = (generation, args)
+            self.requestTime = time.monotonic()
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def takeResult(self):
+        with self.condition:
+            result = self.result
+            self.result = None
+            return result
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.request == None and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                delay = self.requestTime + DEBOUNCE_SECONDS - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                generation, args = self.request
+                self.request = None
+            try:
+                with profiling.span("diff decode"):
+                    result = self.compute(*args)
+            except Exception as e:
+                result = e
+            with self.condition:
+                self.result = (generation, result)
+
+# Caches the widths of measured texts, so every value is only measured once
+class FontMeasurer():
+    def __init__(self):
+        self.font = None
+        self.widths = {}
+
+    def measure(self, text):
+        width = self.widths.get(text)
+        if width == None:
+            if self.font == None:
+                self.font = tkFont.Font()
+            width = max(self.font.measure(line) for line in text.split("\n"))
+            self.widths[text] = width
+        return width
+
+# Shared by all viewer windows, so the font and the measured widths survive
+# closing and reopening the window (like the layout, see getLayout)
+_measurer = None
+
+def getMeasurer():
+    global _measurer
+    if _measurer == None:
+        _measurer = FontMeasurer()
+    return _measurer
 
-def debug(msg):
-    pass
-    #print(msg)
-
-def getIndent(line):
-    indent = line.find(line.strip())
-    #sprint(f'Indent = {indent}')
-    return indent
-    
 class PatchDiffViewer(Frame):
     def __init__(self, parent, preferences):
         super().__init__(parent)
 
         self.prefs = preferences
         self.tree = None
-        self.lines = None
-
-        debug("readStructs")
-        self.structs = readStructs("JD-08.patchdef")
+        self.items = {}      # iid -> (text, values) of all items created in the tree, shown or detached
+        self.treeChildren = {} # parent iid -> iids of the attached children, mirrors the tree
+        self.measurer = getMeasurer()
+        self.columnWidths = None
+        self.generation = 0      # Number of the latest request
+        self.shownGeneration = 0 # Number of the request shown in the tree
+        self.pollId = None
+        self.worker = DiffWorker(computeItems)
 
-        debug("Structures found:")
-        for i, key in enumerate(self.structs):
-            s = self.structs[key]
-            debug(s.name)
-            for f in s.fields:
-                if f.count == 1:
-                    debug(f"  {f.type} {f.name}")
-                else:
-                    debug(f"  {f.type} {f.name}[{f.count}]")
+        self.layout = getLayout(PATCHDEF)
 
         self.chkDiffOnly = tk.IntVar()
         self.chkDiffOnly.set(self.prefs.getValue("DiffsOnly", "0"))
@@ -108,17 +183,17 @@ class PatchDiffViewer(Frame):
         container.grid_columnconfigure(0, weight=1)
         container.grid_rowconfigure(0, weight=1)
 
-    def _open_children(self, parent):
-        self.tree.item(parent, open=True)  # open parent
-        for child in self.tree.get_children(parent):
-            self._open_children(child)    # recursively open children
-
-    def _autosizeColumns(self):
-        for col in patch_header:
+    def _autosizeColumns(self, widths = None):
+        if widths == None:
+            widths = [0] * len(patch_header)
+        widths = [max(w, 20 + self.measurer.measure(col.title())) for col, w in zip(patch_header, widths)]
+        if widths == self.columnWidths:
+            return
+        self.columnWidths = widths
+        for col, width in zip(patch_header, widths):
             self.tree.heading(col, text=col, anchor=CENTER)
-            # adjust the column's width to the header string
-            self.tree.column(col, anchor=CENTER,
-                width= 20 + tkFont.Font().measure(col.title()))
+            # adjust the column's width to the header string and the values
+            self.tree.column(col, anchor=CENTER, width=width)
 
     def _build_tree(self):
         self.tree.column("#0", minwidth = 200)
@@ -126,156 +201,103 @@ class PatchDiffViewer(Frame):
         
         self._autosizeColumns()
 
-    def populate(self, lines):
-        self.lines = lines
-        for child in self.tree.get_children(''):
-            self.tree.delete(child)
-
-        n = 0
-        parentNdx = 0
-        curIndent = 0
-        stack = []
-        for line in lines:
-            #print(f'Inserting line {n}')
-            fields = line.split('\t')
-            indent = getIndent(fields[0])
-            if indent > curIndent:
-                debug("indent")
-                stack.append(parentNdx)
-                parentNdx = n
-                curIndent = indent
-            elif indent < curIndent:
-                while indent < curIndent:
-                    debug("unindent")
-                    parentNdx = stack.pop()
-                    curIndent -= 2 # Assuming 2 spaces per level of indentation. TODO
-            
-            item = ( fields[1], fields[2] )
-            if parentNdx == 0:
-                self.tree.insert('', 'end', text=fields[0].strip(), iid = n, values=item)
+    # Shows the given (iid, parent iid, text, values) items in this order. Items
+    # are identified by their field path, so existing items are reused: only
+    # changed values are updated and hidden items are detached, not deleted.
+    def populate(self, items):
+        with profiling.span("tree population"):
+            wanted = {"": []}
+            texts = {}
+            widths = [0] * len(patch_header)
+            for iid, parent, text, values in items:
+                wanted[iid] = []
+                wanted[parent].append(iid)
+                texts[iid] = (text, values)
+                # adjust column's width if necessary to fit each value
+                for ix, val in enumerate(values):
+                    widths[ix] = max(widths[ix], self.measurer.measure(val))
+
+            # Children of hidden items are detached together with their parent
+            for parent, have in self.treeChildren.items():
+                want = wanted.get(parent)
+                if want == None:
+                    continue
+                want = set(want)
+                removed = [iid for iid in have if not iid in want]
+                if len(removed) > 0:
+                    self.tree.detach(*removed)
+                    have[:] = [iid for iid in have if iid in want]
+
+            self._placeItems(wanted, texts, "")
+            self._autosizeColumns(widths)
+
+    def _placeItems(self, wanted, texts, parent):
+        have = self.treeChildren.setdefault(parent, [])
+        for ndx, iid in enumerate(wanted[parent]):
+            text, values = item = texts[iid]
+            current = self.items.get(iid)
+            if current == None:
+                self.tree.insert(parent, ndx, iid=iid, text=text, values=values, open=True)
+                have.insert(ndx, iid)
             else:
-                self.tree.insert(parentNdx - 1, 'end', text=fields[0].strip(), iid = n, values=item)
-            n += 1
-            # adjust column's width if necessary to fit each value
-            for ix, val in enumerate(item):
-                #print(f'ix={ix}, val={val}')
-                col_w = tkFont.Font().measure(val)
-                if self.tree.column(patch_header[ix],width=None)<col_w:
-                    self.tree.column(patch_header[ix], width=col_w)
-        self._open_children('')
-        self._autosizeColumns()
+                if current != item:
+                    self.tree.item(iid, text=text, values=values)
+                if ndx >= len(have) or have[ndx] != iid: # (Re)attach
+                    if iid in have:
+                        have.remove(iid)
+                    self.tree.move(iid, parent, ndx)
+                    have.insert(ndx, iid)
+            self.items[iid] = item
+            self._placeItems(wanted, texts, iid)
 
     def setPatches(self, leftPatch, rightPatch):
         self.leftPatch  = leftPatch
         self.rightPatch = rightPatch
         
+        self.generation += 1 # Results of earlier requests are discarded
         if leftPatch == None and rightPatch == None:
-            self.populate(["Nothing to show\tn.a.\tn.a."])
+            self.shownGeneration = self.generation
+            self.populate([NOTHING_TO_SHOW])
             return
-        ndx = 0
-        result = []
-        debug(f"dumpStruct diffOnly={self.chkDiffOnly.get()} showUnknown={self.chkShowUnknown.get()} showPrecomputed={self.chkShowPrecomputed.get()}")
-        ndx = dumpStruct(leftPatch, rightPatch, ndx, "Patch", "PatchVST", "", self.chkDiffOnly.get(), 
-                         self.chkShowUnknown.get(), self.chkShowPrecomputed.get(), self.structs, result)
-        self.populate(result)
+        debug(f"dumpLayout diffOnly={self.chkDiffOnly.get()} showUnknown={self.chkShowUnknown.get()} showPrecomputed={self.chkShowPrecomputed.get()}")
+        # Pass copies, the worker must not see later edits of the patches
+        if leftPatch != None:
+            leftPatch = bytes(leftPatch)
+        if rightPatch != None:
+            rightPatch = bytes(rightPatch)
+        self.worker.submit(self.generation, self.layout, leftPatch, rightPatch, self.chkDiffOnly.get(),
+                           self.chkShowUnknown.get(), self.chkShowPrecomputed.get())
+        self._schedulePoll()
+
+    def _schedulePoll(self):
+        if self.pollId == None:
+            self.pollId = self.after(POLL_MS, self._poll)
+
+    # Runs on the Tk thread: shows the result of the latest request once it is available
+    def _poll(self):
+        self.pollId = None
+        result = self.worker.takeResult()
+        if result != None and result[0] == self.generation:
+            self.shownGeneration = self.generation
+            if isinstance(result[1], Exception):
+                self.populate([errorItem(result[1])])
+            else:
+                self.populate(result[1])
+        if self.shownGeneration != self.generation:
+            self._schedulePoll()
+
+    def destroy(self):
+        self.worker.stop()
+        if self.pollId != None:
+            self.after_cancel(self.pollId)
+            self.pollId = None
+        super().destroy()
 
 patch_header = ['Left list', 'Right list']
 patch_dump = [
   'Item1\ta\ta',' Item2\ta\ta','  Item3\ta\ta','  Item3b\tb\tb',' Item4\ta\ta','Item5\ta\ta'
 ]
 
-class FieldDef():
-    def __init__(self, fieldType, fieldName, count, comment):
-        self.type = fieldType
-        self.name = fieldName
-        self.count = count
-        self.comment = comment
-
-    def __repr__(self): 
-        if self.count == 1:
-            return self.type + " " + self.name + self.comment
-        return self.type + " " + self.name + "[" + str(self.count) + "]" + self.comment
-
-class Struct():
-    def __init__(self, structName):
-        self.name = structName
-        self.fields = []
-
-    def __repr__(self): 
-        return "struct " + self.name + " " + str(self.fields)   
-        
-    def addField(self, fieldType, fieldName, count, comment):
-        self.fields.append(FieldDef(fieldType, fieldName, count, comment))
-        
-def readStruct(lines, ndx, structs, namespace):
-    line = lines[ndx].strip()
-    p = line.find(" ")
-    structName = line[p+1:].strip()
-    newStruct = Struct(namespace + structName)
-    structs[namespace + structName] = newStruct
-    ndx += 1
-    while ndx < len(lines):
-        line = lines[ndx].strip()
-        ndx += 1
-        
-        p = line.find("//")
-        if p == -1:
-            comment = ""
-        else:
-            comment = " " + line[p:]
-            line = line[:p].strip()
-       
-        if line == "":
-            continue
-        if line == "{":
-            continue
-        if line == "}": # End of structure
-            return ndx
-
-        if line.find("struct ") > -1:
-            ndx = readStruct(lines, ndx - 1, structs, structName + "::")
-            continue
-            
-        if line.find("std::array") > -1:
-            p = line.find("<")
-            q = line.find(",")
-            fieldType = line[p+1:q].strip()
-            p = line.find(">")
-            count = int(line[q+1:p].strip())
-            debug(f'count={count}')
-            fieldName = line[p+1:].strip()
-        else:
-            p = line.find(" ")
-            fieldType = line[:p].strip()
-            fieldName = line[p+1:].strip()
-            count = 1
-        if not (fieldType == "uint8_t" or fieldType == "uint16le" or fieldType == "char"):
-            if fieldType.find("::") == -1 and structName != "":
-                debug(f'fieldType={fieldType} structName={structName}')
-                fieldType = structName + "::" + fieldType
-        newStruct.addField(fieldType, fieldName, count, comment)
-            
-    return ndx
-
-def readStructs(fileName):
-    structs = {}
-    if not os.path.exists(fileName):
-        print("File not found: " + fileName)
-    else:
-        file = open(fileName, 'r')
-        lines = file.readlines()
-        file.close()
-        print(f'{len(lines)} lines')
-        ndx = 0
-        while ndx < len(lines):
-            line = lines[ndx].strip()
-            if line.find("struct ") > -1:
-                debug(line)
-                ndx = readStruct(lines, ndx, structs, "")
-            else:
-                ndx += 1
-    return structs
-
 def hexValue(data, ndx, count):
     result = ""
     while count > 8:
@@ -288,78 +310,113 @@ def hexValue(data, ndx, count):
     debug("done")
     return result
 
-def addValue(result, field, value, rightValue, indent, showUnknown, diffOnly):
-    if field.name.find("unknown") > -1 and not showUnknown:
+def addValue(result, field, value, rightValue, showUnknown, diffOnly):
+    if field.isUnknown() and not showUnknown:
         return
     if value == rightValue and diffOnly:
         return
 
     if rightValue == None:
-        result.append(f"{indent}{field.name}{field.comment}\t{value}\t{value}")
+        result.append((field, value, value))
     else:
-        result.append(f"{indent}{field.name}{field.comment}\t{value}\t{rightValue}")
-
-def dumpStruct(leftData, rightData, ndx, fieldName, structName, indent, diffOnly, showUnknown, showPrecomputed, structs, result):
-    try:
-        structure = structs[structName]
-    except KeyError: # Couldn't find namespace::structname -> search for structname only
-        try:
-            structure = structs[structName[structName.find("::") + 2:]]
-        except KeyError: # Still not found is an error condition
-            print("Cannot find struct " + structName)
-            return -1
-
-    result.append(indent + fieldName + "\t \t ")
-    indent += "  "
-    
+        result.append((field, value, rightValue))
+
+def computeItems(layout, leftData, rightData, diffOnly, showUnknown, showPrecomputed):
+    return treeItems(layout, dumpLayout(layout, leftData, rightData, diffOnly, showUnknown, showPrecomputed))
+
+# Converts the (entry, left value, right value) rows of dumpLayout to tree items
+def treeItems(layout, rows):
+    items = []
+    for entry, leftValue, rightValue in rows:
+        parent = layout.parentOf(entry)
+        parentId = "" if parent == None else parent.path
+        if entry.isStruct():
+            text = entry.name
+        else:
+            text = entry.name + entry.comment
+        items.append((entry.path, parentId, text, (str(leftValue), str(rightValue))))
+    return items
+
+def listValue(values, count):
+    result = ""
+    for i in range(0, count, 8):
+        if i > 0:
+            result += "\n"
+        result += " ".join(str(v) for v in values[i:i + 8])
+    return result
+
+def formatValue(value, entry):
+    if entry.type == "char":
+        return "'" + value.decode("UTF-8") + "'"
+    if entry.count == 1:
+        return value
+    if entry.type == "uint8_t":
+        return hexValue(bytes(value), 0, entry.count)
+    return listValue(value, entry.count)
+
+def closeStruct(result, headerNdx):
+    if len(result) == headerNdx + 1: # Nothing to show for this structure
+        result.pop()
+
+# Only decodes the fields whose bytes differ, together with their parent structures
+def dumpChanges(layout, leftData, rightData, showUnknown, showPrecomputed):
+    result = [(layout.entries[0], " ", " ")]
+    shown = set([0])
+    for field in changedFields(layout, leftData, rightData):
+        if field.isUnknown() and not showUnknown:
+            continue
+        if field.isPrecomputed() and not showPrecomputed:
+            continue
+        parents = []
+        parent = layout.parentOf(field)
+        while parent != None and not parent.index in shown:
+            parents.append(parent)
+            parent = layout.parentOf(parent)
+        for parent in reversed(parents):
+            result.append((parent, " ", " "))
+            shown.add(parent.index)
+        leftValue = formatValue(layout.decodeField(leftData, field), field)
+        rightValue = formatValue(layout.decodeField(rightData, field), field)
+        addValue(result, field, leftValue, rightValue, showUnknown, True)
+    return result
+
+def dumpLayout(layout, leftData, rightData, diffOnly, showUnknown, showPrecomputed):
+    if diffOnly and leftData != None and rightData != None:
+        return dumpChanges(layout, leftData, rightData, showUnknown, showPrecomputed)
+
+    result = []
     if rightData == None:
         diffOnly = False
+    leftValues = None if leftData == None else layout.decode(leftData)
+    rightValues = None if rightData == None else layout.decode(rightData)
+
+    openStructs = [] # (depth, index of the header line in result)
+    skipDepth = -1
+    for entry in layout.entries:
+        if skipDepth > -1:
+            if entry.depth > skipDepth:
+                continue
+            skipDepth = -1
+        while len(openStructs) > 0 and openStructs[-1][0] >= entry.depth:
+            closeStruct(result, openStructs.pop()[1])
+
+        if entry.isStruct():
+            if entry.isPrecomputed() and not showPrecomputed:
+                skipDepth = entry.depth
+                continue
+            if entry.depth > 0:
+                openStructs.append((entry.depth, len(result)))
+            result.append((entry, " ", " "))
+            continue
 
-    for field in structure.fields:
-        debug(f"dumping field {field.name} {field.type} {field.count}")
         leftValue = ""
         rightValue = ""
-        if field.type == "uint16le":
-            if field.count > 1:
-                print("Cannot read arrays of uint16le yet")
-                return -1
-            if not leftData == None:
-                leftValue = int(leftData[ndx]) + int(leftData[ndx+1]) * 256 
-            if not rightData == None:
-                rightValue = int(rightData[ndx]) + int(rightData[ndx+1]) * 256 
-            ndx += 2 # skip additional byte
-
-            addValue(result, field, leftValue, rightValue, indent, showUnknown, diffOnly)
-        elif field.type == "uint8_t" or field.type == "char":
-            if field.type == "uint8_t":
-                if leftData != None:
-                    if field.count == 1:
-                        leftValue = leftData[ndx]
-                    else:
-                        leftValue = hexValue(leftData, ndx, field.count)
-                if rightData != None:
-                    if field.count == 1:
-                        rightValue = rightData[ndx]
-                    else:
-                        rightValue = hexValue(rightData, ndx, field.count)
-            else:
-                if leftData != None:
-                    leftValue = "'" + leftData[ndx:ndx + field.count].decode("UTF-8") + "'"
-                if rightData != None:
-                    rightValue = "'" + rightData[ndx:ndx + field.count].decode("UTF-8") + "'"
-            ndx += field.count
-                
-            addValue(result, field, leftValue, rightValue, indent, showUnknown, diffOnly)
-        else:
-            for i in range(field.count):
-                structValues = []
-                if field.count > 1: # Array
-                    debug("Array!")
-                    ndx = dumpStruct(leftData, rightData, ndx, field.name + "[" + str(i) + "]", field.type, indent, diffOnly, showUnknown, showPrecomputed, structs, structValues)
-                else:
-                    ndx = dumpStruct(leftData, rightData, ndx, field.name, field.type, indent, diffOnly, showUnknown, showPrecomputed, structs, structValues)
-                if showPrecomputed == 1 or field.name.find("Precomputed") == -1:
-                    if len(structValues) > 1:
-                        result.extend(structValues)
-    return ndx
-
+        if leftValues != None:
+            leftValue = formatValue(layout.value(leftValues, entry), entry)
+        if rightValues != None:
+            rightValue = formatValue(layout.value(rightValues, entry), entry)
+        addValue(result, entry, leftValue, rightValue, showUnknown, diffOnly)
+
+    while len(openStructs) > 0:
+        closeStruct(result, openStructs.pop()[1])
+    return result
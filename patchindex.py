@@ -0,0 +1,164 @@
+#    Copyright (C) 2023 Nils Kronert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    https://github.com/NilsKr/JD08PatchManager
+
+# Searches the patches of a .svd file by parameter values and name. All 256
+# patches are decoded into one compact array per value (a column, in layout
+# order), so a predicate is a scan over a single array. Columns of bytes are
+# scanned with bytes.translate, the matches of all terms are combined as bit
+# masks. The index follows the changes of the file through the per slot
+# change counters of SvdFile and only decodes the slots that changed.
+#
+# Query syntax: terms separated by ",", all of which must match, e.g.
+#   tone[1].tvf.cutoffFreq > 64, effectsGroupB.reverbType = 3, name ~ pad
+# A term without an operator is a name substring. Values are compared with
+# the stored (raw) values.
+
+import operator
+import re
+from array import array
+from itertools import compress
+import profiling
+from patchlayout import ROOT_NAME
+from svdfile import PATCH_COUNT
+
+OPERATORS = {
+    "<": operator.lt,
+    "<=": operator.le,
+    "=": operator.eq,
+    "==": operator.eq,
+    "!=": operator.ne,
+    ">=": operator.ge,
+    ">": operator.gt,
+}
+TYPE_CODES = { "uint8_t": "B", "uint16le": "H" }
+
+TERM = re.compile(r"^\s*([\w\.\[\]]+)\s*(<=|>=|==|!=|<|>|=)\s*(\d+)\s*$")
+NAME_TERM = re.compile(r"^\s*name\s*~\s*(.*?)\s*$", re.IGNORECASE)
+ELEMENT = re.compile(r"^(.*)\[(\d+)\]$")
+
+ALL_SLOTS = b"\x01" * PATCH_COUNT
+
+debug = profiling.getDebug("patchindex")
+
+class Query():
+    def __init__(self):
+        self.predicates = [] # (path, operator, value)
+        self.names = []      # Lower case name substrings
+
+    def isEmpty(self):
+        return len(self.predicates) == 0 and len(self.names) == 0
+
+def parseQuery(text):
+    query = Query()
+    for term in text.split(","):
+        if term.strip() == "":
+            continue
+        match = TERM.match(term)
+        if match != None:
+            query.predicates.append((match.group(1), OPERATORS[match.group(2)], int(match.group(3))))
+            continue
+        match = NAME_TERM.match(term)
+        if match != None:
+            query.names.append(match.group(1).lower())
+        else:
+            query.names.append(term.strip().lower())
+    return query
+
+def andMasks(left, right):
+    return (int.from_bytes(left, "big") & int.from_bytes(right, "big")).to_bytes(PATCH_COUNT, "big")
+
+class PatchIndex():
+    def __init__(self, svd, layout):
+        self.svd = svd
+        self.layout = layout
+        self.columns = []  # Per value index: array of the value of all slots (char fields: list of bytes)
+        self.names = []    # Lower case patch names
+        self.loadCount = -1
+        self.slotVersions = None
+        self.refresh()
+
+    # Brings the index up to date with the file
+    def refresh(self):
+        svd = self.svd
+        if svd.loadCount != self.loadCount:
+            self.build()
+        elif svd.slotVersions != self.slotVersions:
+            changed = [i for i in range(PATCH_COUNT) if svd.slotVersions[i] != self.slotVersions[i]]
+            self.update(changed)
+
+    def decodeSlot(self, index):
+        return self.layout.decode(self.svd.getPatch(index))
+
+    def build(self):
+        with profiling.span("index build"):
+            values = list(zip(*[self.decodeSlot(i) for i in range(PATCH_COUNT)])) # Value index -> all slots
+            self.columns = []
+            for entry in self.layout.fields:
+                if entry.type == "char":
+                    self.columns.append(list(values[entry.valueIndex]))
+                    continue
+                for k in range(entry.valueIndex, entry.valueIndex + entry.count):
+                    self.columns.append(array(TYPE_CODES[entry.type], values[k]))
+            self.names = [self.svd.getPatchName(i).lower() for i in range(PATCH_COUNT)]
+            self.loadCount = self.svd.loadCount
+            self.slotVersions = array('L', self.svd.slotVersions)
+
+    def update(self, slots):
+        debug(f"Updating slots {slots}")
+        for index in slots:
+            for k, value in enumerate(self.decodeSlot(index)):
+                self.columns[k][index] = value
+            self.names[index] = self.svd.getPatchName(index).lower()
+            self.slotVersions[index] = self.svd.slotVersions[index]
+
+    # Returns the value index of a field path ("Patch." may be omitted, elements
+    # of arrays are addressed as e.g. "zenHeader.empty[3]")
+    def valueIndex(self, path):
+        if not path.startswith(ROOT_NAME + "."):
+            path = ROOT_NAME + "." + path
+        entry = self.layout.byPath.get(path)
+        element = 0
+        if entry == None:
+            match = ELEMENT.match(path)
+            if match != None:
+                entry = self.layout.byPath.get(match.group(1))
+                element = int(match.group(2))
+        if entry == None or entry.isStruct() or entry.type == "char" or element >= entry.count:
+            raise KeyError(f"Unknown parameter '{path}'")
+        return entry.valueIndex + element
+
+    def column(self, path):
+        return self.columns[self.valueIndex(path)]
+
+    # Returns one byte per slot, 1 if the value of the slot matches
+    def matchValues(self, path, op, value):
+        column = self.column(path)
+        if column.typecode == "B":
+            return column.tobytes().translate(bytes(op(v, value) for v in range(256)))
+        return bytes(op(v, value) for v in column)
+
+    def matchName(self, text):
+        return bytes(text in name for name in self.names)
+
+    def find(self, query):
+        self.refresh()
+        mask = ALL_SLOTS
+        for path, op, value in query.predicates:
+            mask = andMasks(mask, self.matchValues(path, op, value))
+        for text in query.names:
+            mask = andMasks(mask, self.matchName(text))
+        return list(compress(range(PATCH_COUNT), mask))
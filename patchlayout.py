@@ -0,0 +1,380 @@
+#    Copyright (C) 2023 Nils Kronert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    https://github.com/NilsKr/JD08PatchManager
+
+#    The patch layout is derived from JD-08.hpp as present in:
+#    JDTools - Patch conversion utility for Roland JD-800 / JD-990
+#    2022 by Johannes Schultz
+#    License: BSD 3-clause
+#    https://github.com/sagamusix/JDTools
+
+# Reads the pseudo-C structures in JD-08.patchdef and compiles them into a flat
+# table of fields with absolute offsets, so nothing needs to walk the nested
+# structures at runtime. The compiled table is kept in memory for the lifetime
+# of the process and persisted next to the patchdef file.
+
+import bisect
+import hashlib
+import marshal
+import os
+import struct
+import tempfile
+import profiling
+
+PATCHDEF = "JD-08.patchdef"
+ROOT_STRUCT = "PatchVST"
+ROOT_NAME = "Patch"
+
+CACHE_SUFFIX = ".cache"
+CACHE_VERSION = 2 # 2: marshal instead of JSON
+
+# Entry flags
+FLAG_STRUCT      = 1 # Entry is a (sub)structure header, not a value
+FLAG_UNKNOWN     = 2 # Field name contains "unknown"
+FLAG_PRECOMPUTED = 4 # Field is (part of) a precomputed section
+
+TYPE_SIZES = { "uint8_t": 1, "char": 1, "uint16le": 2 }
+FORMAT_CODES = { "uint8_t": "B", "char": "s", "uint16le": "H" }
+
+debug = profiling.getDebug("patchlayout")
+
+class FieldDef():
+    def __init__(self, fieldType, fieldName, count, comment):
+        self.type = fieldType
+        self.name = fieldName
+        self.count = count
+        self.comment = comment
+
+    def __repr__(self):
+        if self.count == 1:
+            return self.type + " " + self.name + self.comment
+        return self.type + " " + self.name + "[" + str(self.count) + "]" + self.comment
+
+class Struct():
+    def __init__(self, structName):
+        self.name = structName
+        self.fields = []
+
+    def __repr__(self):
+        return "struct " + self.name + " " + str(self.fields)
+
+    def addField(self, fieldType, fieldName, count, comment):
+        self.fields.append(FieldDef(fieldType, fieldName, count, comment))
+
+def readStruct(lines, ndx, structs, namespace):
+    line = lines[ndx].strip()
+    p = line.find(" ")
+    structName = line[p+1:].strip()
+    newStruct = Struct(namespace + structName)
+    structs[namespace + structName] = newStruct
+    ndx += 1
+    while ndx < len(lines):
+        line = lines[ndx].strip()
+        ndx += 1
+
+        p = line.find("//")
+        if p == -1:
+            comment = ""
+        else:
+            comment = " " + line[p:]
+            line = line[:p].strip()
+
+        if line == "":
+            continue
+        if line == "{":
+            continue
+        if line == "}": # End of structure
+            return ndx
+
+        if line.find("struct ") > -1:
+            ndx = readStruct(lines, ndx - 1, structs, structName + "::")
+            continue
+
+        if line.find("std::array") > -1:
+            p = line.find("<")
+            q = line.find(",")
+            fieldType = line[p+1:q].strip()
+            p = line.find(">")
+            count = int(line[q+1:p].strip())
+            debug(f'count={count}')
+            fieldName = line[p+1:].strip()
+        else:
+            p = line.find(" ")
+            fieldType = line[:p].strip()
+            fieldName = line[p+1:].strip()
+            count = 1
+        if not fieldType in TYPE_SIZES:
+            if fieldType.find("::") == -1 and structName != "":
+                debug(f'fieldType={fieldType} structName={structName}')
+                fieldType = structName + "::" + fieldType
+        newStruct.addField(fieldType, fieldName, count, comment)
+
+    return ndx
+
+def readStructs(fileName):
+    structs = {}
+    if not os.path.exists(fileName):
+        debug("File not found: " + fileName)
+    else:
+        file = open(fileName, 'r')
+        lines = file.readlines()
+        file.close()
+        debug(f'{len(lines)} lines')
+        ndx = 0
+        while ndx < len(lines):
+            line = lines[ndx].strip()
+            if line.find("struct ") > -1:
+                debug(line)
+                ndx = readStruct(lines, ndx, structs, "")
+            else:
+                ndx += 1
+    return structs
+
+def findStruct(structs, structName):
+    try:
+        return structs[structName]
+    except KeyError: # Couldn't find namespace::structname -> search for structname only
+        try:
+            return structs[structName[structName.find("::") + 2:]]
+        except KeyError: # Still not found is an error condition
+            raise KeyError("Cannot find struct " + structName)
+
+class LayoutEntry():
+    def __init__(self, path, name, comment, offset, fieldType, count, size, depth, flags):
+        self.path = path        # e.g. "Patch.tone[1].tvf.cutoffFreq"
+        self.name = name        # e.g. "cutoffFreq" or "tone[1]"
+        self.comment = comment
+        self.offset = offset    # Absolute offset within the patch
+        self.type = fieldType   # uint8_t, uint16le, char or the struct name
+        self.count = count      # Number of array elements, 1 for scalars and structures
+        self.size = size        # Size in bytes
+        self.depth = depth      # Nesting level, 0 for the root
+        self.flags = flags
+        self.valueIndex = -1    # Position of the (first) value in a decoded patch
+        self.index = -1         # Position in the layout
+        self.parent = -1        # Position of the enclosing structure in the layout
+        self.decoder = None     # struct.Struct decoding this field only
+
+    def __repr__(self):
+        return f"{self.path} @{self.offset} {self.type}[{self.count}] flags={self.flags}"
+
+    def isStruct(self):
+        return self.flags & FLAG_STRUCT != 0
+
+    def isUnknown(self):
+        return self.flags & FLAG_UNKNOWN != 0
+
+    def isPrecomputed(self):
+        return self.flags & FLAG_PRECOMPUTED != 0
+
+    def toList(self):
+        return [self.path, self.name, self.comment, self.offset, self.type, self.count, self.size, self.depth, self.flags]
+
+class PatchLayout():
+    def __init__(self, entries):
+        self.entries = entries
+        self.fields = [e for e in entries if not e.isStruct()]
+        self.byPath = {}
+        parents = []
+        for i, e in enumerate(entries):
+            self.byPath[e.path] = e
+            e.index = i
+            del parents[e.depth:]
+            if len(parents) > 0:
+                e.parent = parents[-1]
+            if e.isStruct():
+                parents.append(i)
+        self.fieldOffsets = [e.offset for e in self.fields]
+        self.size = entries[0].size if len(entries) > 0 else 0
+        self.decoder = self.buildDecoder()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def field(self, path):
+        return self.byPath[path]
+
+    # Builds one struct format covering the whole patch, so a patch is decoded
+    # with a single unpack_from. Numeric arrays are unpacked into one value per
+    # element, char arrays into a single bytes value.
+    def buildDecoder(self):
+        fmt = "<"
+        offset = 0
+        valueIndex = 0
+        for e in self.fields:
+            if e.offset > offset:
+                fmt += str(e.offset - offset) + "x"
+            e.valueIndex = valueIndex
+            e.decoder = getDecoder("<" + str(e.count) + FORMAT_CODES[e.type])
+            if e.type == "char":
+                valueIndex += 1
+            else:
+                valueIndex += e.count
+            fmt += e.decoder.format[1:]
+            offset = e.offset + e.size
+        self.valueCount = valueIndex
+        return struct.Struct(fmt)
+
+    def decode(self, data):
+        return self.decoder.unpack_from(data)
+
+    def value(self, values, entry):
+        ndx = entry.valueIndex
+        if entry.count == 1 or entry.type == "char":
+            return values[ndx]
+        return values[ndx:ndx + entry.count]
+
+    # Decodes a single field, returns the same as value() on a decoded patch
+    def decodeField(self, data, entry):
+        values = entry.decoder.unpack_from(data, entry.offset)
+        if entry.count == 1 or entry.type == "char":
+            return values[0]
+        return values
+
+    # Returns the fields overlapping the byte range [start, end)
+    def fieldsInRange(self, start, end):
+        first = bisect.bisect_right(self.fieldOffsets, start) - 1
+        if first < 0 or self.fields[first].offset + self.fields[first].size <= start:
+            first += 1
+        last = bisect.bisect_left(self.fieldOffsets, end)
+        return self.fields[first:last]
+
+    def parentOf(self, entry):
+        if entry.parent < 0:
+            return None
+        return self.entries[entry.parent]
+
+_decoders = {}
+
+# Fields share the struct.Struct of their format (there are only a few distinct ones)
+def getDecoder(fmt):
+    decoder = _decoders.get(fmt)
+    if decoder == None:
+        decoder = _decoders[fmt] = struct.Struct(fmt)
+    return decoder
+
+def compileStruct(structs, structName, path, name, comment, offset, depth, flags, entries):
+    structure = findStruct(structs, structName)
+    header = LayoutEntry(path, name, comment, offset, structure.name, 1, 0, depth, flags | FLAG_STRUCT)
+    entries.append(header)
+    start = offset
+    for field in structure.fields:
+        fieldFlags = flags
+        if field.name.find("unknown") > -1:
+            fieldFlags |= FLAG_UNKNOWN
+        if field.name.find("Precomputed") > -1:
+            fieldFlags |= FLAG_PRECOMPUTED
+        if field.type in TYPE_SIZES:
+            size = TYPE_SIZES[field.type] * field.count
+            entries.append(LayoutEntry(path + "." + field.name, field.name, field.comment, offset,
+                                       field.type, field.count, size, depth + 1, fieldFlags))
+            offset += size
+        elif field.count == 1:
+            offset = compileStruct(structs, field.type, path + "." + field.name, field.name, field.comment,
+                                   offset, depth + 1, fieldFlags, entries)
+        else:
+            for i in range(field.count):
+                elementName = field.name + "[" + str(i) + "]"
+                offset = compileStruct(structs, field.type, path + "." + elementName, elementName, field.comment,
+                                       offset, depth + 1, fieldFlags, entries)
+    header.size = offset - start
+    return offset
+
+def compileLayout(structs, rootStruct = ROOT_STRUCT, rootName = ROOT_NAME):
+    entries = []
+    compileStruct(structs, rootStruct, rootName, rootName, "", 0, 0, 0, entries)
+    return PatchLayout(entries)
+
+def getCacheFileName(fileName):
+    return fileName + CACHE_SUFFIX
+
+def fileHash(fileName):
+    file = open(fileName, 'rb')
+    digest = hashlib.sha1(file.read()).hexdigest()
+    file.close()
+    return digest
+
+def readCache(fileName, stat):
+    cacheName = getCacheFileName(fileName)
+    try:
+        file = open(cacheName, 'rb')
+        cache = marshal.loads(file.read())
+        file.close()
+    except (OSError, ValueError, EOFError, TypeError): # e.g. an older JSON cache
+        return None, None
+
+    if not isinstance(cache, dict) or cache.get("version") != CACHE_VERSION:
+        return None, None
+    if cache.get("mtime") == stat.st_mtime_ns and cache.get("size") == stat.st_size:
+        return cache, None
+    # mtime changed (e.g. after a checkout): fall back to comparing the content hash
+    digest = fileHash(fileName)
+    if cache.get("sha1") == digest:
+        return cache, digest
+    return None, digest
+
+def writeCache(fileName, stat, digest, layout):
+    cache = {
+        "version": CACHE_VERSION,
+        "mtime": stat.st_mtime_ns,
+        "size": stat.st_size,
+        "sha1": digest,
+        "entries": [tuple(e.toList()) for e in layout.entries],
+    }
+    cacheName = getCacheFileName(fileName)
+    # A unique temporary file, so concurrent instances never replace the cache with a partial one
+    try:
+        fd, tempName = tempfile.mkstemp(prefix=os.path.basename(cacheName) + ".", suffix=".tmp",
+                                        dir=os.path.dirname(os.path.abspath(cacheName)))
+    except OSError as e: # The cache is an optimization only, e.g. the directory may be read-only
+        debug(f"Cannot write layout cache {cacheName}: {e}")
+        return
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(marshal.dumps(cache))
+        os.replace(tempName, cacheName)
+    except OSError as e:
+        os.unlink(tempName)
+        debug(f"Cannot write layout cache {cacheName}: {e}")
+
+def loadLayout(fileName):
+    if not os.path.exists(fileName):
+        debug("File not found: " + fileName)
+        return PatchLayout([])
+
+    stat = os.stat(fileName)
+    cache, digest = readCache(fileName, stat)
+    if cache != None:
+        debug(f"Layout loaded from cache {getCacheFileName(fileName)}")
+        layout = PatchLayout([LayoutEntry(*e) for e in cache["entries"]])
+        if digest != None: # Content unchanged, refresh the mtime key
+            writeCache(fileName, stat, digest, layout)
+        return layout
+
+    layout = compileLayout(readStructs(fileName))
+    if digest == None:
+        digest = fileHash(fileName)
+    writeCache(fileName, stat, digest, layout)
+    return layout
+
+_layouts = {}
+
+def getLayout(fileName = PATCHDEF):
+    key = os.path.abspath(fileName)
+    layout = _layouts.get(key)
+    if layout == None:
+        layout = _layouts[key] = loadLayout(fileName)
+    return layout
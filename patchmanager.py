@@ -18,6 +18,14 @@
 #
 #    https://github.com/NilsKr/JD08PatchManager
 
+import time
+startTime = time.perf_counter()
+
+import sys
+import profiling
+if __name__ == "__main__": # Before importing the other modules, see profiling.py
+    sys.argv = profiling.configure(sys.argv)
+
 import tkinter as tk
 from tkinter import *
 from tkinter import ttk
@@ -25,14 +33,13 @@ from tkinter import messagebox
 from tkinter import filedialog
 from tkinter import simpledialog
 from preferences import Preferences
-from patchdiffviewer import PatchDiffViewer
-import sys
+# The diff viewer and the patch layout (patchdiffviewer, patchlayout, patchdiff)
+# are imported on first use, they are not needed to show the patch lists
+from svdfile import SvdFile, SvdError, PATCH_NAME_LENGTH
 import os
-import struct
 
 VERSION = "1.1"
-JD_SIG = "JD PA11"
-JX_SIG   = "JX PA11"
+STARTUP_BUDGET_SECONDS = 1.0 # Checked with --startup-time
 
 ctrlPressed = False
 
@@ -54,20 +61,7 @@ def getSaveAsName(fileName):
                                                          ("all files", "*.*")))
     return saveAsName
 
-def getFileSize(fileName):
-    try:
-        if not os.path.exists(fileName):
-            return -1;
-        file_size = os.path.getsize(fileName)
-        print(f"File size of {fileName} in Bytes is {file_size}")
-        return file_size
-    except FileNotFoundError:
-        print("File not found.")
-    except OSError:
-        print("OS error occurred.")    
-
-def debug(msg):
-    print(msg)
+debug = profiling.getDebug("patchmanager")
     
 def all_children(wid) :
     _list = wid.winfo_children()
@@ -93,18 +87,22 @@ def childrenByType(wid, typeName) :
 CONFIGFILE = "patchmanager.cfg"
 prefs = None
 buttonBar = None
+lastQuery = ""
+similarity = None # similarity.SimilarityIndex of the open files, created on first use
+SIMILAR_COUNT = 10
+MERGE_LIST_COUNT = 20 # Conflicts listed after merging
 
 class App(Tk):
     def onBeforeExit(self):
         if self.leftFile.canClose():
             if self.rightFile.canClose():
+                prefs.flush()
                 self.destroy()
 
-    def __init__(self, title, size, *args):
+    def __init__(self, title, size, *args, measureStartup = False):
         global prefs
         global buttonBar
         prefs = Preferences(CONFIGFILE)
-        print(f"prefs={prefs}")
         path1 = None
         path2 = None
         if len(args) > 1:
@@ -114,6 +112,7 @@ class App(Tk):
         
         # main setup
         super().__init__()
+        prefs.scheduler = self.after
         self.title(title)
         self.geometry(f'{size[0]}x{size[1]}')
         self.minsize(size[0],size[1])
@@ -141,31 +140,46 @@ class App(Tk):
 
         self.protocol("WM_DELETE_WINDOW", self.onBeforeExit)
 
+        self.startupTime = None
+        if measureStartup:
+            self.after_idle(self.reportStartupTime)
+
         # run 
         self.mainloop()
 
+    # Time from starting patchmanager.py until the main window (with the files
+    # given on the command line) has been laid out
+    def reportStartupTime(self):
+        self.update_idletasks()
+        self.startupTime = time.perf_counter() - startTime
+        print(f"Startup time {self.startupTime:.3f}s (budget {STARTUP_BUDGET_SECONDS:.3f}s)")
+        self.destroy()
+
 class PatchFile(Frame):
     isLeftList = True
     
     def __init__(self, parent, preloadFileName):
         super().__init__(parent)
 
-        self.data = None
-        self.orig = None
+        self.svd = None
         self.cursel = None
+        self.labels = None # Labels of the rows in patchList
+        self.bankDiff = None # Per slot differences with the other file, shared by both files while comparing
+        self.otherFile = None
+        self.index = None # patchindex.PatchIndex of the file, created by the first search
         self.preloadFileName = preloadFileName
 
         self.create_widgets()
 
     def canClose(self):
-        if self.data == None or self.data == self.orig:
+        if self.svd == None or not self.svd.isModified():
             return True
 
         answer = messagebox.askyesnocancel("WARNING", f"The following file is not saved. Save?\n\n{self.fileName}", default='cancel')
         if answer == None:
             return False
         if answer:
-            self.onSave()
+            return self.onSave() # Keep the file open if saving failed
         return True
 
     def setFileName(self, fileName):
@@ -174,16 +188,24 @@ class PatchFile(Frame):
         self.fileNameVar.set(os.path.basename(fileName) + " (" + curdir + ")")
     
     def tryFile(self, fileName):
-        data = self.loadFile(fileName)
-        if data == None:
-            return;
+        try:
+            svd = SvdFile(fileName, prefs.getValue("MemoryMapped", "0") == "1")
+        except SvdError as e:
+            messagebox.showerror("Invalid file", str(e))
+            return
 
         self.setFileName(fileName)
 
-        self.data = data
-        self.orig = data[:]
+        if self.svd != None:
+            self.svd.close()
+        self.svd = svd
+        self.index = None
 
+        comparing = self.bankDiff != None
+        self.bankDiff = None
         self.populateList()
+        if comparing:
+            self.compareBanks()
         
         self.updateButtons()
     
@@ -202,6 +224,7 @@ class PatchFile(Frame):
         curdir = os.path.dirname(fileName)
         if curdir != defaultDir:
             prefs.setValue("defaultdir", curdir)
+            prefs.save()
 
         self.tryFile(fileName)
     
@@ -212,13 +235,13 @@ class PatchFile(Frame):
     
     def updateButtons(self):
         renameState = "disabled"
-        if self.data == None:
+        if self.svd == None:
             revertState = btnState = "disabled"
         else:
             if self.itemSelected():
                 renameState = "normal"
                 
-            if self.data == self.orig:
+            if not self.svd.isModified():
                 btnState = "disabled"
             else:   
                 btnState = "normal"
@@ -226,7 +249,7 @@ class PatchFile(Frame):
             if not self.itemSelected():
                 revertState = "disabled"
             else:   
-                if self.getPatch(self.cursel[0]) == self.getOriginalPatch(self.cursel[0]):
+                if not any(self.svd.isPatchModified(ndx) for ndx in self.cursel):
                     revertState = "disabled"
                 else:   
                     revertState = "normal"
@@ -236,9 +259,10 @@ class PatchFile(Frame):
         self.btnRename.configure(state=renameState)
         self.btnRevertAll.configure(state=btnState)
 
+    # Returns True if the file was saved
     def onSave(self):
         global ctrlPressed
-        if self.data != None:
+        if self.svd != None:
             if ctrlPressed:
                 ctrlPressed = False # This gets stuck sometimes due to the save as dialog, so we reset it here
                 saveAsName = getSaveAsName(self.fileName)
@@ -248,52 +272,277 @@ class PatchFile(Frame):
                 saveAsName = self.fileName
             
             if saveAsName == None:
-                return
-
-            f = open(saveAsName, mode="wb")
-            f.write(self.data)
-            f.close()    
+                return False
+
+            history = self.getHistory(saveAsName)
+            loaded = None
+            if history != None and len(history) == 0 and saveAsName == self.fileName:
+                loaded = (bytes(self.svd.orig), self.svd.patchStart) # Kept as the first snapshot once saved
+
+            try:
+                self.svd.save(saveAsName)
+            except OSError as e:
+                messagebox.showerror("Save failed", f"The file '{saveAsName}' could not be saved:\n\n{e}")
+                return False
             
-            if saveAsName == self.fileName:
-                self.orig = self.data[:]
-            else:
+            if saveAsName != self.fileName:
                 self.setFileName(saveAsName)
-            self.onRevertAll()
+            if loaded != None:
+                self.recordHistory(history, *loaded, "loaded")
+            if history != None:
+                self.recordHistory(history, self.svd.orig, self.svd.patchStart, "saved")
+            self.refreshList() # Remove the "(was : ...)" remarks
+            self.updateButtons()
+            return True
+        return False
             
     def onRevert(self):
-        if self.data != None:
-            ndx = self.cursel[0]
-            self.updatePatch(ndx, self.getOriginalPatch(ndx))
+        if self.svd != None:
+            self.svd.revertPatches(self.cursel)
+            self.showPatches(list(self.cursel))
+
+    # Snapshot history of the file, None if switched off with History=0
+    def getHistory(self, fileName):
+        if prefs.getValue("History", "1") != "1":
+            return None
+        from history import History
+        try:
+            return History(fileName)
+        except (OSError, ValueError) as e:
+            debug(f"Cannot read the history of {fileName}: {e}")
+            return None
+
+    def recordHistory(self, history, data, patchStart, label):
+        try:
+            history.record(data, patchStart, label)
+        except OSError as e:
+            messagebox.showwarning("History", f"The snapshot could not be stored:\n\n{e}")
+
+    # Selects the slots that differ between two snapshots (or a snapshot and the
+    # current state) and shows the first of them in the diff window
+    def onHistory(self):
+        if self.svd == None:
+            return
+        history = self.getHistory(self.fileName)
+        if history == None or len(history) == 0:
+            messagebox.showinfo("History", "There are no snapshots of this file yet, they are stored when saving")
+            return
+        from history import describe
+        listing = "\n".join(describe(history, n) for n in range(max(1, len(history) - 9), len(history) + 1))
+        text = simpledialog.askstring(title="History",
+                                      prompt=f"{listing}\n\nCompare snapshot N with the current file, or 'A, B' with each other:")
+        if text == None:
+            return
+        try:
+            numbers = [int(t) for t in text.split(",")]
+            if len(numbers) == 1:
+                hashes = self.svd.getPatchHashes()
+                slots = [i for i, d in enumerate(history.getPatchHashes(numbers[0])) if d != hashes[i]]
+                getRight = self.svd.getPatch
+            elif len(numbers) == 2:
+                slots = history.changedSlots(numbers[0], numbers[1])
+                getRight = lambda slot: history.getPatch(numbers[1], slot)
+            else:
+                raise ValueError()
+        except ValueError:
+            messagebox.showerror("History", "Enter one or two snapshot numbers separated by ','")
+            return
+        except IndexError as e:
+            messagebox.showerror("History", e.args[0])
+            return
+        if len(slots) == 0:
+            messagebox.showinfo("History", "No patches differ")
+            return
+        self.selectSlots(slots)
+        if diffWindow == None:
+            buttonBar.openDiffWindow(prefs)
+        lst = childrenByType(diffWindow, "PatchDiffViewer")[0]
+        lst.setPatches(history.getPatch(numbers[0], slots[0]), getRight(slots[0]))
+
+    # Three-way merge: takes the patches that only the other file changed since
+    # the chosen base file, and selects the patches both changed in both lists
+    def onMerge(self):
+        if self.svd == None or self.otherFile.svd == None:
+            return
+        fileName = filedialog.askopenfilename(initialdir = os.path.dirname(self.fileName),
+              title = "Select the file both files started from",
+              filetypes = (("JD-08/JX-08 backup files", "*.svd"),
+                           ("all files", "*.*")))
+        if fileName == "" or fileName == None:
+            return
+        try:
+            base = SvdFile(fileName)
+        except SvdError as e:
+            messagebox.showerror("Invalid file", str(e))
+            return
+        from merge import Merge, describeConflict
+        merge = Merge(base, self.svd, self.otherFile.svd)
+        merged = merge.apply()
+        self.refreshSlots(merged)
+        conflicts = merge.getConflicts()
+        for patchFile in (self, self.otherFile):
+            patchFile.selectSlots(conflicts)
+        lines = [f"{len(merged)} patches merged, {len(conflicts)} changed in both files"]
+        if len(conflicts) > 0:
+            from patchlayout import PATCHDEF, getLayout
+            layout = getLayout(PATCHDEF)
+            lines.append("")
+            for slot in conflicts[0:MERGE_LIST_COUNT]:
+                lines.append(f"{self.svd.getPatchLabel(slot)}: {describeConflict(merge.getConflict(layout, slot))}")
+            if len(conflicts) > MERGE_LIST_COUNT:
+                lines.append("...")
+        base.close()
+        messagebox.showinfo("Merge", "\n".join(lines))
+
+    # Exports the selected patches to a patch bundle
+    def onExport(self):
+        if not self.itemSelected():
+            return
+        fileName = filedialog.asksaveasfilename(initialdir = os.path.dirname(self.fileName),
+              title = "Export the selected patches", defaultextension = ".jdp",
+              filetypes = (("JD-08/JX-08 patch bundles", "*.jdp"), ("all files", "*.*")))
+        if fileName == "" or fileName == None:
+            return
+        from patchbundle import exportPatches, BundleError
+        try:
+            exportPatches(self.svd, list(self.cursel), fileName)
+        except (BundleError, OSError) as e:
+            messagebox.showerror("Export failed", f"The patches could not be exported:\n\n{e}")
+
+    # Imports a patch bundle into the selected slots, or into consecutive slots
+    # starting at the (first) selected one
+    def onImport(self):
+        if not self.itemSelected():
+            return
+        fileName = filedialog.askopenfilename(initialdir = os.path.dirname(self.fileName),
+              title = "Import a patch bundle",
+              filetypes = (("JD-08/JX-08 patch bundles", "*.jdp"), ("all files", "*.*")))
+        if fileName == "" or fileName == None:
+            return
+        from patchbundle import readBundle, importPatches, BundleError
+        try:
+            bundle = readBundle(fileName)
+        except (BundleError, OSError) as e:
+            messagebox.showerror("Import failed", f"The patch bundle could not be read:\n\n{e}")
+            return
+        if bundle.getModel() != None and bundle.getModel() != self.svd.getModel():
+            if not messagebox.askyesno("Import", f"The patches were exported from a {bundle.getModel()}, import them anyway?"):
+                return
+        if len(self.cursel) == len(bundle):
+            toIndices = list(self.cursel)
+        else:
+            toIndices = list(range(self.cursel[0], min(self.cursel[0] + len(bundle), 256)))
+        if len(toIndices) == 0:
+            return
+        importPatches(self.svd, toIndices, bundle)
+        self.showPatches(toIndices)
+
+    def getIndex(self):
+        if self.index == None:
+            from patchlayout import PATCHDEF, getLayout
+            from patchindex import PatchIndex
+            self.index = PatchIndex(self.svd, getLayout(PATCHDEF))
+        return self.index
+
+    # Selects the patches matching the query in both lists
+    def onFind(self):
+        global lastQuery
+        text = simpledialog.askstring(title="Find patches",
+                                      prompt="Parameter conditions and/or name, separated by ','\n(e.g. tone[1].tvf.cutoffFreq > 64, name ~ pad)",
+                                      initialvalue=lastQuery)
+        if text == None:
+            return
+        lastQuery = text
+        from patchindex import parseQuery
+        query = parseQuery(text)
+        if query.isEmpty():
+            return
+        found = 0
+        for patchFile in (self, self.otherFile):
+            if patchFile == None or patchFile.svd == None:
+                continue
+            try:
+                slots = patchFile.getIndex().find(query)
+            except KeyError as e:
+                messagebox.showerror("Find patches", e.args[0])
+                return
+            patchFile.selectSlots(slots)
+            found += len(slots)
+        if found == 0:
+            messagebox.showinfo("Find patches", "No matching patches found")
+
+    # Lists the patches of both files that are most like the selected one
+    def onSimilar(self):
+        global similarity
+        if not self.itemSelected():
+            return
+        if similarity == None:
+            from patchlayout import PATCHDEF, getLayout
+            from similarity import SimilarityIndex
+            similarity = SimilarityIndex(getLayout(PATCHDEF))
+        files = [f for f in (self, self.otherFile) if f != None and f.svd != None]
+        similarity.setSources([f.getIndex() for f in files])
+        index = self.cursel[0]
+        lines = []
+        for distance, source, slot in similarity.nearest(0, index, SIMILAR_COUNT):
+            side = "left" if files[source].isLeftList else "right"
+            lines.append(f"{side} {files[source].svd.getPatchLabel(slot)}  ({distance:.3f})")
+        if len(lines) == 0:
+            lines.append("No similar patches found")
+        messagebox.showinfo("Similar patches", f"Patches most like {self.svd.getPatchLabel(index)}:\n\n" + "\n".join(lines))
+
     def onRename(self):
         if self.cursel[0] != None:
             newName = simpledialog.askstring(title="Rename",
                                   prompt="Rename patch to:", 
-                                  initialvalue=self.getPatchName(self.data, self.cursel[0]))
+                                  initialvalue=self.svd.getPatchName(self.cursel[0]))
 
             if newName != None:
-                self.setPatchName(self.data, self.cursel[0], newName)
+                self.setPatchName(self.cursel[0], newName)
     def onRevertAll(self):
-        if self.data != None:
-            self.data = self.orig[:]
-            temp = self.cursel
-            for i in range(256):
-                self.updatePatch(i, self.getOriginalPatch(i))
-            self.setSelection(temp[0])
+        if self.svd != None:
+            slots = self.svd.getModifiedSlots()
+            self.svd.revertAll()
+            self.refreshSlots(slots)
+    def onUndo(self):
+        if self.svd != None:
+            self.refreshSlots(self.svd.undo())
+    def onRedo(self):
+        if self.svd != None:
+            self.refreshSlots(self.svd.redo())
     def onPatchDblclick(self, event):
-        if not (self.data == None or self.otherFile.data == None):
+        if not (self.svd == None or self.otherFile.svd == None):
             self.otherFile.copyPatchFrom(self)
     def onPatchClick(self, event):
-        if not (self.data == None or self.otherFile.data == None):
+        if not (self.svd == None or self.otherFile.svd == None):
             self.cursel = self.patchList.curselection()
         self.updateButtons()
     def onKeyUp(self, e):
         global buttonBar
-        if e.keysym == 'F2': 
+        if ctrlPressed and e.keysym == 'z': # Undo
+            self.onUndo()
+        elif ctrlPressed and e.keysym == 'y': # Redo
+            self.onRedo()
+        elif e.keysym == 'F2': 
             self.onRename()
         elif e.keysym == 'Up' or e.keysym == 'Down': # Cursor up/down
             self.onPatchClick(e)
         elif e.keysym == 'space': # Space bar
             self.onPatchDblclick(e)
+        elif e.keysym == 'b': # Compare all slots of both files
+            self.toggleCompare()
+        elif e.keysym == 'f': # Find patches in both files
+            self.onFind()
+        elif e.keysym == 's': # Patches similar to the selected one
+            self.onSimilar()
+        elif e.keysym == 'h': # Compare with saved snapshots
+            self.onHistory()
+        elif e.keysym == 'm': # Merge the changes of the other file
+            self.onMerge()
+        elif e.keysym == 'e': # Export the selected patches
+            self.onExport()
+        elif e.keysym == 'i': # Import patches into the selected slots
+            self.onImport()
         elif e.keysym == 'd': # Diff
             if diffWindow == None:
                 buttonBar.openDiffWindow(prefs)
@@ -334,7 +583,8 @@ class PatchFile(Frame):
         scrollBar = Scrollbar(scrollFrame)#, orientation = 'vertical', width = 20)
 
         # exportselection=False below allows the listbox to show the selected item when the focus is elsewhere
-        self.patchList = patchList = Listbox(listFrame, yscrollcommand = scrollBar.set, exportselection=False) 
+        self.patchList = patchList = Listbox(listFrame, yscrollcommand = scrollBar.set, exportselection=False,
+                                           selectmode=EXTENDED) 
         patchList.insert(1, "Browse for .svd file to display")
         patchList.bind('<Double-1>', self.onPatchDblclick)
         patchList.bind('<ButtonRelease-1>', self.onPatchClick)
@@ -369,61 +619,117 @@ class PatchFile(Frame):
             self.tryFile(self.preloadFileName)
         self.updateButtons()
 
-    def getPatchSectionOffset(self, data):
-        for i in range(5):
-            section = data[i * 16: (i + 1) * 16]
-            if section[0:4].decode() == "PATa":
-                offs = struct.unpack("i", section[8:12])[0]
-                #print(f"Found! {offs}")
-                return offs
-                
-        print("Section PAT not found!") # TODO: throw exception?
-        return 0x168260
-        
-    def getPatchOffset(self, data, index):
-        return self.getPatchSectionOffset(data) + 16 + index * 0x800 # 16 is the size of the patch section metadata
-    
     def getPatch(self, index):
-        offs = self.getPatchOffset(self.data, index)
-        return self.data[offs:offs + 0x0800]
+        return self.svd.getPatch(index)
 
     def getOriginalPatch(self, index):
-        offs = self.getPatchOffset(self.orig, index)
-        return self.orig[offs:offs + 0x0800]
-
-    def setPatch(self, index, data):
-        offs = self.getPatchOffset(self.data, index)
-        for i in range(len(data)):
-            self.data[offs + i] = data[i]
-
-    def getPatchNumber(self, ndx):
-        bank = chr((ndx >> 6) + 65)
-        subbank = ((ndx >> 3) & 7) + 1
-        patch = (ndx & 7) + 1
-        return f"{bank}{subbank}:{patch}"
-        
-    def updatePatch(self, toIndex, newPatch):
-        self.setPatch(toIndex, newPatch)
-        self.patchList.delete(toIndex)
-        newLabel = self.getPatchNumber(toIndex) + " " + self.getPatchName(self.data, toIndex)
-        origPatch = self.getOriginalPatch(toIndex)
-        if origPatch != newPatch:
-            newLabel += " (was : " + self.getPatchName(self.orig, toIndex) + ")"
-        self.patchList.insert(toIndex, newLabel)
-        toIndex += 1
+        return self.svd.getOriginalPatch(index)
+
+    def getPatchLabel(self, index):
+        if self.bankDiff == None:
+            return self.svd.getPatchLabel(index)
+        return self.svd.getPatchLabel(index, self.bankDiff[index])
+
+    def markSlot(self, index):
+        if self.bankDiff != None and self.bankDiff[index] != None:
+            self.patchList.itemconfig(index, background="#ffe4e1")
+
+    # Updates the rows of the given slots (default all) whose label has changed, keeping the selection
+    def refreshList(self, indices = None):
+        with profiling.span("list refresh"):
+            if self.svd == None:
+                return
+            if indices == None:
+                indices = range(256)
+            labels = [(index, self.getPatchLabel(index)) for index in indices]
+            selected = self.patchList.curselection()
+            for index, label in labels:
+                if self.labels[index] == label:
+                    continue
+                self.labels[index] = label
+                self.patchList.delete(index)
+                self.patchList.insert(index, label)
+                self.markSlot(index)
+                if index in selected:
+                    self.patchList.select_set(index)
+
+    def refreshSlots(self, slots):
+        if slots == None:
+            return
+        self.compareSlots(slots)
+        self.refreshList(slots)
+        self.updateButtons()
+
+    def setBankDiff(self, bankDiff):
+        self.bankDiff = bankDiff
+        self.refreshList()
+
+    def compareBanks(self):
+        with profiling.span("bank diff"):
+            other = self.otherFile
+            if self.svd == None or other == None or other.svd == None:
+                return
+            from patchlayout import PATCHDEF, getLayout
+            from patchdiff import diffHashedSlots
+            bankDiff = diffHashedSlots(getLayout(PATCHDEF), self.svd.getPatchHashes(), other.svd.getPatchHashes(),
+                                       self.getPatch, other.getPatch)
+            self.setBankDiff(bankDiff)
+            other.setBankDiff(bankDiff)
+
+    def toggleCompare(self):
+        if self.bankDiff == None:
+            self.compareBanks()
+        else:
+            self.setBankDiff(None)
+            self.otherFile.setBankDiff(None)
+
+    def compareSlots(self, slots):
+        if self.bankDiff != None:
+            from patchlayout import PATCHDEF, getLayout
+            from patchdiff import diffSlot
+            layout = getLayout(PATCHDEF)
+            for index in slots:
+                if self.svd.getPatchHash(index) == self.otherFile.svd.getPatchHash(index):
+                    self.bankDiff[index] = None
+                else:
+                    self.bankDiff[index] = diffSlot(layout, index, self.getPatch(index), self.otherFile.getPatch(index))
+            self.otherFile.refreshList(slots)
+
+    def showPatch(self, toIndex):
+        self.showPatches([toIndex])
+
+    # Refreshes the list after patches have been changed in the file and moves the selection to the slot
+    # following the last one
+    def showPatches(self, indices):
+        self.compareSlots(indices)
+        self.refreshList(indices)
+        toIndex = indices[-1] + 1
         if toIndex == 256:
             toIndex = 0
         self.setSelection(toIndex)
-        self.updateButtons()
         
     def copyPatchFrom(self, src):
-        if src.cursel == None or self.cursel == None:
-            return
-        fromIndex = src.cursel[0]
-        toIndex   = self.cursel[0]
-        newPatch  = src.getPatch(fromIndex)
-        self.updatePatch(toIndex, newPatch)
+        with profiling.span("patch copy"):
+            if not (src.itemSelected() and self.itemSelected()):
+                return
+            fromIndices = list(src.cursel)
+            if len(self.cursel) == len(fromIndices):
+                toIndices = list(self.cursel)
+            else: # Copy to consecutive slots starting at the (first) selected one
+                toIndices = list(range(self.cursel[0], min(self.cursel[0] + len(fromIndices), 256)))
+                fromIndices = fromIndices[0:len(toIndices)]
+            self.svd.copyPatches(toIndices, src.svd, fromIndices)
+            self.showPatches(toIndices)
             
+    def selectSlots(self, slots):
+        self.patchList.selection_clear(0, END)
+        for index in slots:
+            self.patchList.select_set(index)
+        if len(slots) > 0:
+            self.patchList.see(slots[0])
+        self.cursel = self.patchList.curselection()
+        self.updateButtons()
+
     def setSelection(self, toIndex):
         self.patchList.selection_clear(0, END)
         self.patchList.select_set(toIndex)
@@ -431,59 +737,25 @@ class PatchFile(Frame):
         self.cursel = self.patchList.curselection()
         self.updateButtons()
 
-    def getSynthName(self, data):
-        patchName = data[96:96 + 16]
-        return patchName.decode("UTF-8").strip()
-
-    def getPatchName(self, data, index):
-        offs = self.getPatchOffset(data, index)
-        patchName = data[offs + 16:offs + 32]
-        return patchName.decode("UTF-8").strip()
-
-    def setPatchName(self, data, index, newName):
+    def setPatchName(self, index, newName):
         if len(newName) == 0:
             messagebox.showerror("Value required", "The patch name cannot be empty")
             return
-        if len(newName) >  16:
-            messagebox.showwarning("Value truncated", "The patch name will be truncated to 16 characters")
-            newName = newName[0:16]
-        if len(newName) < 16:
-            newName = newName.ljust(16, ' ')
+        if len(newName.encode()) > PATCH_NAME_LENGTH: # Non-ASCII characters take more than one byte
+            messagebox.showwarning("Value truncated", "The patch name will be truncated to 16 bytes")
             
-        offs = self.getPatchOffset(data, index)
-        arr = bytearray()
-        arr.extend(newName.encode())
-        data[offs + 16:offs + 32] = arr
-        self.updatePatch(index, self.getPatch(index))
+        self.svd.setPatchName(index, newName)
+        self.showPatch(index)
         
     def populateList(self):
-        data = self.data
-        self.patchList.delete(0,END)
-        for i in range(256):
-            self.patchList.insert('end', self.getPatchNumber(i) + " " + self.getPatchName(data, i))
-        self.cursel = None
-        self.updateButtons()
-    
-    def loadFile(self, fileName):
-        n = getFileSize(fileName)
-        if n == -1:
-            messagebox.showerror("Invalid file", f"The file '{fileName}' does not exist")
-            return None;
-        if n < 0x001E8800:
-            messagebox.showerror("Invalid file", f"The file '{fileName}' is invalid")
-            return None;
-
-        f = open(fileName, mode="rb")
-        data = f.read()
-        f.close()    
-
-        data = bytearray(data) # Convert from bytes() to bytearray() because we want to be able to change the data
-        #print("&" + self.getSynthName(data) + "&")
-        if b"N\0SVD5" != data[0:6]:
-            messagebox.showerror("Invalid file", f"The file '{fileName}' is invalid (header should be 'N.SVD5' but is {data[0:6]})")
-            return None;
-        
-        return data;
+        with profiling.span("list population"):
+            self.labels = [self.getPatchLabel(i) for i in range(256)]
+            self.patchList.delete(0,END)
+            self.patchList.insert(END, *self.labels)
+            for i in range(256):
+                self.markSlot(i)
+            self.cursel = None
+            self.updateButtons()
         
 diffWindow = None        
 
@@ -527,6 +799,9 @@ class ButtonBar(Frame):
     def copyRightToLeft(button):
         button.leftList.copyPatchFrom(button.rightList)
 
+    def compareFiles(button):
+        button.leftList.toggleCompare()
+
     def onBeforeExit(self):
         global diffWindow
         if not diffWindow == None:
@@ -553,6 +828,7 @@ class ButtonBar(Frame):
         f.config(bg ="pink")
         f.pack(expand = True, fill = BOTH)
 
+        from patchdiffviewer import PatchDiffViewer
         self.lst = PatchDiffViewer(f, prefs)
         self.lst.pack(expand = True, fill = BOTH) #.grid(row = 0, column = 0, sticky = 'nswe', padx = 4, pady = 4)
 
@@ -561,12 +837,20 @@ class ButtonBar(Frame):
         # create the widgets 
         btnCopyRight = Button(self, text = '>>', command=self.copyLeftToRight)
         btnCopyLeft  = Button(self, text = '<<', command=self.copyRightToLeft)
+        btnCompare   = Button(self, text = '\u2260', command=self.compareFiles)
         # btnDiff      = Button(self, text = 'Diff', command=self.openDiff)
 
         # place the widgets 
         btnCopyRight.place(relx=.5, rely=.5, y=-20, height=30, anchor=CENTER)
         btnCopyLeft.place(relx=.5, rely=.5, y=20, height=30, anchor=CENTER)
+        btnCompare.place(relx=.5, rely=.5, y=60, height=30, anchor=CENTER)
         # btnDiff.place(relx=.5, rely=.5, y=60, height=30, anchor=CENTER)
 
 # It is possible to pass one or two file names from the command line that will be opened
-App('JD-08/JX-08 Patch Manager v' + VERSION, (650,350), *sys.argv) 
\ No newline at end of file
+if __name__ == "__main__":
+    # Usage: patchmanager.py [--startup-time] [left.svd [right.svd]]
+    args = [arg for arg in sys.argv if not arg.startswith("--")]
+    app = App('JD-08/JX-08 Patch Manager v' + VERSION, (650,350), *args,
+              measureStartup = "--startup-time" in sys.argv)
+    if app.startupTime != None and app.startupTime > STARTUP_BUDGET_SECONDS:
+        sys.exit(1) 
\ No newline at end of file
@@ -0,0 +1,76 @@
+#    Copyright (C) 2023 Nils Kronert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    https://github.com/NilsKr/JD08PatchManager
+
+# Content-addressed store of patch payloads (hash -> 2 KB bytes) shared by all
+# open files, so a patch that is copied to several slots or files (or kept in
+# snapshots) is held in memory once. Owners (e.g. SvdFile) register with the
+# store and report the hashes they use; payloads no owner uses are dropped by
+# collect(). Objects that keep a payload themselves (like the undo journal)
+# simply hold a reference to the bytes object.
+
+import hashlib
+import weakref
+
+MIN_COLLECT_SIZE = 1024 # Number of payloads before intern() collects unused ones
+
+# Content hash of a patch (or any other data, e.g. history chunks), equal patches
+# have equal hashes regardless of the file or slot
+def hashPatch(patch):
+    return hashlib.blake2b(patch, digest_size=16).hexdigest()
+
+class PatchStore():
+    def __init__(self):
+        self.payloads = {} # Hash -> bytes
+        self.owners = weakref.WeakSet()
+        self.collectAt = MIN_COLLECT_SIZE
+
+    def __len__(self):
+        return len(self.payloads)
+
+    # Owners implement storedHashes(), returning the hashes of the payloads they use
+    def addOwner(self, owner):
+        self.owners.add(owner)
+
+    # Returns (hash, payload) of the patch, the payload is shared with all equal patches
+    def intern(self, patch, digest = None):
+        if digest == None:
+            digest = hashPatch(patch)
+        payload = self.payloads.get(digest)
+        if payload == None:
+            if len(self.payloads) >= self.collectAt:
+                self.collect()
+            payload = self.payloads[digest] = bytes(patch)
+        return digest, payload
+
+    def get(self, digest):
+        return self.payloads.get(digest)
+
+    def collect(self):
+        used = set()
+        for owner in list(self.owners):
+            used.update(owner.storedHashes())
+        for digest in [d for d in self.payloads if not d in used]:
+            del self.payloads[digest]
+        self.collectAt = max(MIN_COLLECT_SIZE, 2 * len(self.payloads))
+
+_store = None
+
+def getStore():
+    global _store
+    if _store == None:
+        _store = PatchStore()
+    return _store
@@ -1,61 +1,101 @@
 import os
+import tempfile
+import profiling
 
+SAVE_DELAY_MS = 1000 # Changes within this time are written to the file at once
+
+debug = profiling.getDebug("preferences")
+
+# The configuration file is parsed once. Every line is kept (comments and blank
+# lines included) so the file is written back in its original order, the index
+# maps a property name to its line.
 class Preferences():
 
     def __init__(self, fileName):
         self.dirty = True
-        self.lines = []
+        self.lines = []  # [property name or None, value, comment, original line]
+        self.index = {}
         self.fileName = fileName
+        self.scheduler = None # e.g. Tk.after, used to defer writing the file
+        self.pendingSave = False
         if (os.path.exists(fileName)):
             file = open(fileName, 'r')
-            self.lines = file.readlines()
-            print(self.lines)
+            for line in file.readlines():
+                self.addLine(line)
             file.close()
             self.dirty = False
 
+    def addLine(self, line):
+        text = line.rstrip("\n")
+        comment = ""
+        p = text.find("#")
+        if p > -1:
+            comment = text[p:]
+            text = text[0:p] # Remove comment
+        prop, sep, value = text.partition("=")
+        prop = prop.strip()
+        if sep == "" or prop == "":
+            self.lines.append([None, None, comment, line])
+            return
+        if not prop in self.index: # The first occurrence wins
+            self.index[prop] = len(self.lines)
+        self.lines.append([prop, value.strip(), comment, line])
+
     def getValue(self, propertyName, defaultValue):
-        for line in self.lines:
-            p = line.find("#")
-            if p > -1:
-                line = line[0:p] # Remove comment
-            arr = line.split("=", 2)
-            if len(arr) > 1:
-                prop = arr[0].strip()
-                if prop == propertyName:
-                    value = arr[1].strip()
-                    print(f"Found {prop}={value}")
-                    return value
-         
-        print(f"Value not found for {propertyName}. Returning default {defaultValue}")
-        return defaultValue
-        
+        ndx = self.index.get(propertyName)
+        if ndx == None:
+            debug(f"Value not found for {propertyName}. Returning default {defaultValue}")
+            return defaultValue
+        return self.lines[ndx][1]
+
     def setValue(self, propertyName, newValue):
+        ndx = self.index.get(propertyName)
+        if ndx == None:
+            self.index[propertyName] = len(self.lines)
+            self.lines.append([propertyName, newValue, "", None])
+        elif self.lines[ndx][1] == newValue:
+            return
+        else:
+            self.lines[ndx][1] = newValue
+            self.lines[ndx][3] = None # Line needs to be rebuilt
         self.dirty = True
-        changed = False
-        for i in range(len(self.lines)):
-            line = self.lines[i]
-            p = line.find("#")
-            comment = ""
-            if p > -1:
-                comment = line[p:]
-                line = line[0:p] # Remove comment
-            arr = line.split("=", 2)
-            if len(arr) > 1:
-                prop = arr[0].strip()
-                if prop == propertyName:
-                    value = arr[1].strip()
-                    print(f"Found {prop}={value}")
-                    self.lines[i] = propertyName + "=" + newValue + comment + "\n"
-                    changed = True
-                    break
-        if not changed:
-            self.lines.append(f"{propertyName}={newValue}\n")
 
+    # Writes the file later if a scheduler has been set, so repeated changes
+    # result in a single write
     def save(self):
-        if self.dirty:
-            file = open(self.fileName, 'w')
-            print(self.lines)
-            file.writelines(self.lines)
-            file.close()
-            print(f"Configuration {self.fileName} written")
-            self.dirty = False
+        if not self.dirty:
+            return
+        if self.scheduler == None:
+            self.flush()
+        elif not self.pendingSave:
+            self.pendingSave = True
+            self.scheduler(SAVE_DELAY_MS, self.flush)
+
+    def flush(self):
+        self.pendingSave = False
+        if not self.dirty:
+            return
+        text = ""
+        for prop, value, comment, line in self.lines:
+            if line == None:
+                line = prop + "=" + value + comment + "\n"
+            text += line
+        # Write a temporary file and rename it, so the file is never left half written
+        directory = os.path.dirname(os.path.abspath(self.fileName))
+        try:
+            fd, tempName = tempfile.mkstemp(prefix=".cfg", dir=directory)
+        except OSError as e:
+            debug(f"Cannot write configuration {self.fileName}: {e}")
+            return
+        try:
+            with os.fdopen(fd, 'w') as file:
+                file.write(text)
+            if os.path.exists(self.fileName): # mkstemp creates the file accessible by the owner only
+                os.chmod(tempName, os.stat(self.fileName).st_mode & 0o7777)
+            os.replace(tempName, self.fileName)
+        except OSError as e:
+            os.unlink(tempName)
+            debug(f"Cannot write configuration {self.fileName}: {e}")
+            return
+        debug(f"Configuration {self.fileName} written")
+        self.dirty = False
@@ -0,0 +1,149 @@
+#    Copyright (C) 2023 Nils Kronert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    https://github.com/NilsKr/JD08PatchManager
+
+# Timing spans, cProfile sessions and debug output, all off by default.
+#
+#   JD08_PROFILE=1 (or --profile)                  time the spans, report them on exit
+#   JD08_PROFILE=cprofile (or --profile=cprofile)  run cProfile, write patchmanager.prof on exit
+#   JD08_DEBUG=1 (or --debug)                      print the debug messages of all modules
+#   JD08_DEBUG=svdfile,patchlayout                 ... of the given modules only
+#
+# Modules get their debug function with getDebug() at import time, so the
+# settings must be made (configure) before the other modules are imported.
+# When disabled, debug is a function doing nothing and span() returns a
+# shared object whose enter/exit do nothing.
+
+import atexit
+import os
+import time
+
+PROFILE_FILE = "patchmanager.prof"
+
+spansEnabled = False
+debugModules = None # None: no debug output, empty set: all modules
+profiler = None
+spanTimes = {}      # Span name -> durations in seconds
+
+class Span():
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        duration = time.perf_counter() - self.start
+        times = spanTimes.get(self.name)
+        if times == None:
+            times = spanTimes.setdefault(self.name, [])
+        times.append(duration)
+        return False
+
+class NullSpan():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_SPAN = NullSpan()
+
+def span(name):
+    if not spansEnabled:
+        return NULL_SPAN
+    return Span(name)
+
+def noDebug(msg):
+    pass
+
+def getDebug(moduleName):
+    if debugModules == None or (len(debugModules) > 0 and not moduleName in debugModules):
+        return noDebug
+    def debug(msg):
+        print(f"[{moduleName}] {msg}")
+    return debug
+
+def percentile(sortedTimes, p):
+    ndx = max(0, min(len(sortedTimes) - 1, round(p / 100 * len(sortedTimes)) - 1))
+    return sortedTimes[ndx]
+
+def reportSpans():
+    if len(spanTimes) == 0:
+        return
+    print(f"{'span':<20}{'count':>7}{'total ms':>11}{'mean':>9}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}")
+    for name in sorted(spanTimes):
+        times = sorted(spanTimes[name])
+        total = sum(times)
+        row = [total, total / len(times), percentile(times, 50), percentile(times, 90),
+               percentile(times, 99), times[-1]]
+        print(f"{name:<20}{len(times):>7}" + "".join(f"{t * 1000:>{11 if i == 0 else 9}.3f}" for i, t in enumerate(row)))
+
+def stopProfiler():
+    profiler.disable()
+    import pstats
+    profiler.dump_stats(PROFILE_FILE)
+    pstats.Stats(profiler).sort_stats("cumulative").print_stats(30)
+    print(f"Profile written to {PROFILE_FILE}")
+
+def enableSpans():
+    global spansEnabled
+    if not spansEnabled:
+        spansEnabled = True
+        atexit.register(reportSpans)
+
+def enableProfiler():
+    global profiler
+    if profiler == None:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        atexit.register(stopProfiler)
+
+def enableDebug(modules):
+    global debugModules
+    names = set(m.strip() for m in modules.split(",") if m.strip() != "")
+    if names <= {"1", "all"}:
+        names = set()
+    debugModules = names
+
+def setProfile(value):
+    if value == "cprofile":
+        enableProfiler()
+    elif value not in ("", "0"):
+        enableSpans()
+
+# Applies the environment variables and the --profile/--debug options, returns
+# the remaining command line arguments
+def configure(argv):
+    setProfile(os.environ.get("JD08_PROFILE", ""))
+    if os.environ.get("JD08_DEBUG", "") not in ("", "0"):
+        enableDebug(os.environ["JD08_DEBUG"])
+    args = []
+    for arg in argv:
+        option, sep, value = arg.partition("=")
+        if option == "--profile":
+            setProfile(value if sep != "" else "1")
+        elif option == "--debug":
+            enableDebug(value if sep != "" else "1")
+        else:
+            args.append(arg)
+    return args
+
+configure([]) # Environment variables apply to every program using these modules
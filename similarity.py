@@ -0,0 +1,134 @@
+#    Copyright (C) 2023 Nils Kronert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    https://github.com/NilsKr/JD08PatchManager
+
+# Finds the patches that are most alike. Every patch is described by the
+# parameters of the layout that are neither precomputed nor unknown (nor part
+# of the header), each scaled to 0..255 over all patches, so the matrix is one
+# bytes object per parameter with one byte per patch. The distance between two
+# patches is the euclidean distance of these vectors.
+#
+# The distances to all patches are computed a parameter at a time without a
+# Python loop over the patches: bytes.translate maps the column to the low and
+# high bytes of the squared differences, which are written into 4 byte lanes of
+# a bytearray and summed as one big integer. The sums cannot overflow a lane
+# (at most 65025 per parameter, so up to 66051 parameters).
+
+import heapq
+import math
+import sys
+from array import array
+import profiling
+from patchlayout import ROOT_NAME
+
+HEADER_PATH = ROOT_NAME + ".zenHeader"
+LANE_SIZE = 4
+
+debug = profiling.getDebug("similarity")
+
+# Returns the value indices of the parameters describing the sound of a patch
+def getFeatures(layout):
+    features = []
+    for entry in layout.fields:
+        if entry.isPrecomputed() or entry.isUnknown() or entry.type == "char" or entry.path.startswith(HEADER_PATH):
+            continue
+        features.extend(range(entry.valueIndex, entry.valueIndex + entry.count))
+    return features
+
+# Returns the column scaled to 0..255 as bytes, None if all values are equal
+def normalize(column):
+    low = min(column)
+    high = max(column)
+    if low == high:
+        return None
+    span = high - low
+    if column.typecode == "B":
+        return column.tobytes().translate(bytes((v - low) * 255 // span if low <= v <= high else 0 for v in range(256)))
+    return bytes((v - low) * 255 // span for v in column)
+
+class SimilarityIndex():
+    def __init__(self, layout):
+        self.layout = layout
+        self.features = getFeatures(layout)
+        self.sources = []   # patchindex.PatchIndex of the files
+        self.offsets = []   # First row of each source
+        self.matrix = []    # Per (non-constant) feature: bytes with the scaled value of every row
+        self.rowCount = 0
+        self.signature = None
+
+    def setSources(self, indices):
+        self.sources = list(indices)
+
+    def refresh(self):
+        signature = []
+        for ndx in self.sources:
+            ndx.refresh()
+            signature.append((id(ndx.svd), ndx.loadCount, ndx.slotVersions.tobytes()))
+        if signature != self.signature:
+            self.build()
+            self.signature = signature
+
+    def build(self):
+        with profiling.span("similarity build"):
+            self.offsets = []
+            self.rowCount = 0
+            for ndx in self.sources:
+                self.offsets.append(self.rowCount)
+                self.rowCount += len(ndx.names)
+            self.matrix = []
+            for k in self.features:
+                column = array(self.sources[0].columns[k].typecode) if len(self.sources) > 0 else array("B")
+                for ndx in self.sources:
+                    column.extend(ndx.columns[k])
+                scaled = normalize(column) if len(column) > 0 else None
+                if scaled != None:
+                    self.matrix.append(scaled)
+            debug(f"{self.rowCount} patches, {len(self.matrix)} of {len(self.features)} parameters vary")
+
+    # Returns the squared distances (0..65025 per parameter) of all rows to the given row
+    def distances(self, row):
+        total = 0
+        lanes = bytearray(self.rowCount * LANE_SIZE)
+        for column in self.matrix:
+            value = column[row]
+            squares = [(v - value) ** 2 for v in range(256)]
+            lanes[0::LANE_SIZE] = column.translate(bytes(d & 0xFF for d in squares))
+            lanes[1::LANE_SIZE] = column.translate(bytes(d >> 8 for d in squares))
+            total += int.from_bytes(lanes, "little")
+        result = array("I")
+        result.frombytes(total.to_bytes(self.rowCount * LANE_SIZE, "little"))
+        if sys.byteorder != "little":
+            result.byteswap()
+        return result
+
+    # Returns the k patches most like slot of the given source as (distance,
+    # source number, slot) ordered by distance, which is 0..1
+    def nearest(self, source, slot, k = 10):
+        self.refresh()
+        if len(self.matrix) == 0:
+            return []
+        with profiling.span("similarity search"):
+            row = self.offsets[source] + slot
+            distances = self.distances(row)
+            scale = 1 / (255 * math.sqrt(len(self.matrix)))
+            best = heapq.nsmallest(k + 1, range(self.rowCount), key=distances.__getitem__)
+            result = []
+            for other in best:
+                if other == row:
+                    continue
+                otherSource = max(i for i, offset in enumerate(self.offsets) if offset <= other)
+                result.append((math.sqrt(distances[other]) * scale, otherSource, other - self.offsets[otherSource]))
+            return result[0:k]
@@ -0,0 +1,544 @@
+#    Copyright (C) 2023 Nils Kronert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    https://github.com/NilsKr/JD08PatchManager
+
+# Model of a JD-08/JX-08 .svd backup file, independent of the GUI so it can be
+# used from scripts and on machines without a display.
+
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import profiling
+from array import array
+from journal import Journal
+from patchstore import getStore, hashPatch
+
+SVD_HEADER = b"N\0SVD5"
+MIN_FILE_SIZE = 0x001E8800
+
+PATCH_COUNT = 256
+PATCH_SIZE = 0x800
+PATCH_NAME_OFFSET = 16
+PATCH_NAME_LENGTH = 16
+
+JD_SIG = "JD PA11"
+JX_SIG = "JX PA11"
+SYNTH_NAME_OFFSET = 96
+MODEL_JD08 = "JD-08"
+MODEL_JX08 = "JX-08"
+
+PATCH_SECTION = "PATa"
+SECTION_ENTRY_SIZE = 16
+SECTION_HEADER_SIZE = 16 # Metadata at the start of the patch section
+SECTION_ENTRY = struct.Struct("<4s4sii") # Name, unknown, offset, (presumably) size
+MAX_SECTIONS = 64
+
+debug = profiling.getDebug("svdfile")
+
+class SvdError(Exception):
+    pass
+
+def getFileSize(fileName):
+    try:
+        if not os.path.exists(fileName):
+            return -1;
+        file_size = os.path.getsize(fileName)
+        debug(f"File size of {fileName} in Bytes is {file_size}")
+        return file_size
+    except FileNotFoundError:
+        debug("File not found.")
+    except OSError:
+        debug("OS error occurred.")
+
+FICLONE = 0x40049409 # Linux ioctl to share the data blocks of two files (btrfs, XFS, ...)
+COPY_CHUNK_SIZE = 1024 * 1024
+
+def writeAt(fd, data, offset):
+    data = memoryview(data)
+    while len(data) > 0:
+        if hasattr(os, "pwrite"):
+            n = os.pwrite(fd, data, offset)
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            n = os.write(fd, data)
+        data = data[n:]
+        offset += n
+
+# Copies the contents of a file to the (empty) file fd, as a reflink if possible
+def copyFile(srcName, fd):
+    src = open(srcName, mode="rb")
+    try:
+        srcFd = src.fileno()
+        size = os.fstat(srcFd).st_size
+        try:
+            import fcntl
+            fcntl.ioctl(fd, FICLONE, srcFd)
+            return
+        except (ImportError, OSError):
+            pass
+        copied = 0
+        if hasattr(os, "copy_file_range"): # In-kernel copy, may also share blocks
+            try:
+                while copied < size:
+                    n = os.copy_file_range(srcFd, fd, size - copied, copied, copied)
+                    if n == 0:
+                        break
+                    copied += n
+            except OSError:
+                pass
+        while copied < size:
+            chunk = os.pread(srcFd, COPY_CHUNK_SIZE, copied) if hasattr(os, "pread") else src.read(COPY_CHUNK_SIZE)
+            if len(chunk) == 0:
+                raise OSError(f"Unexpected end of file {srcName}")
+            writeAt(fd, chunk, copied)
+            copied += len(chunk)
+    finally:
+        src.close()
+
+def syncDirectory(directory):
+    if os.name == "nt":
+        return
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def getPatchNumber(ndx):
+    bank = chr((ndx >> 6) + 65)
+    subbank = ((ndx >> 3) & 7) + 1
+    patch = (ndx & 7) + 1
+    return f"{bank}{subbank}:{patch}"
+
+# Inverse of getPatchNumber, e.g. "B2:3" -> 74
+def parsePatchNumber(text):
+    text = text.strip().upper()
+    if len(text) != 4 or not text[0] in "ABCD" or not text[1] in "12345678" or text[2] != ":" or not text[3] in "12345678":
+        raise ValueError(f"Invalid patch number '{text}', expected e.g. A1:1")
+    return ((ord(text[0]) - 65) << 6) + ((int(text[1]) - 1) << 3) + int(text[3]) - 1
+
+def padPatchName(newName):
+    if len(newName) == 0:
+        raise ValueError("The patch name cannot be empty")
+    return newName[0:PATCH_NAME_LENGTH].ljust(PATCH_NAME_LENGTH, ' ')
+
+# Returns the name as PATCH_NAME_LENGTH bytes of UTF-8. Longer names are cut
+# after the last character that fits, so no character is split.
+def encodePatchName(newName):
+    encoded = padPatchName(newName).encode()
+    if len(encoded) > PATCH_NAME_LENGTH:
+        encoded = encoded[0:PATCH_NAME_LENGTH].decode("UTF-8", "ignore").encode()
+    return encoded.ljust(PATCH_NAME_LENGTH, b' ')
+
+class Section():
+    def __init__(self, name, offset, size):
+        self.name = name
+        self.offset = offset
+        self.size = size
+
+    def __repr__(self):
+        return f"{self.name} @{self.offset:#x} size={self.size:#x}"
+
+# Directory of the sections following the 16 byte file header. Each entry is
+# 16 bytes; entries that aren't valid sections (e.g. padding) are skipped. The
+# directory ends where the data of the first section starts, or after
+# MAX_SECTIONS entries.
+class SectionDirectory():
+    def __init__(self, data, fileSize):
+        self.sections = []
+        self.byName = {}
+        end = fileSize
+        ndx = SECTION_ENTRY_SIZE
+        while ndx + SECTION_ENTRY_SIZE <= end and ndx <= MAX_SECTIONS * SECTION_ENTRY_SIZE:
+            name, unknown, offset, size = SECTION_ENTRY.unpack_from(data, ndx)
+            ndx += SECTION_ENTRY_SIZE
+            if not (name.isalnum() and name.isascii()) or offset < ndx or offset >= fileSize:
+                continue
+            section = Section(name.decode(), offset, size)
+            self.sections.append(section)
+            self.byName.setdefault(section.name, section) # The first entry of a name counts
+            end = min(end, offset) # The directory cannot overlap the section data
+
+    def __len__(self):
+        return len(self.sections)
+
+    def find(self, name):
+        return self.byName.get(name)
+
+# The original file contents are kept read-only, either read into memory or
+# memory mapped. Modified patches are stored per slot as immutable bytes, so
+# only edited slots take additional memory and patches can be handed out as
+# memoryview slices without copying. The bytes of modified slots come from the
+# shared PatchStore, so equal patches in several slots or files are stored
+# once. The content hash of every slot is known (original slots are hashed on
+# first use), so slots are compared by hash.
+class SvdFile():
+    def __init__(self, fileName = None, useMmap = False):
+        self.fileName = None
+        self.fileStat = None
+        self.orig = None
+        self.modified = {} # Slot index -> patch contents (bytes) for modified slots
+        self.modifiedHashes = {} # Slot index -> content hash for modified slots
+        self.origHashes = None   # Content hashes of the original slots, computed when first needed
+        self.sections = None
+        self.patchStart = 0
+        self.patchEnd = 0
+        self.patchOffsets = None
+        self.journal = Journal()
+        self.useMmap = useMmap
+        self.loadCount = 0        # Incremented by every load
+        self.slotVersions = None  # Per slot change counters, lets caches (e.g. PatchIndex) update incrementally
+        getStore().addOwner(self)
+        if fileName != None:
+            self.load(fileName, useMmap)
+
+    def load(self, fileName, useMmap = None):
+        with profiling.span("load"):
+            if useMmap == None:
+                useMmap = self.useMmap
+
+            n = getFileSize(fileName)
+            if n == -1:
+                raise SvdError(f"The file '{fileName}' does not exist")
+            if n == None or n < MIN_FILE_SIZE:
+                raise SvdError(f"The file '{fileName}' is invalid")
+
+            f = open(fileName, mode="rb")
+            if useMmap:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                data = f.read()
+            f.close()
+
+            try:
+                if SVD_HEADER != data[0:6]:
+                    raise SvdError(f"The file '{fileName}' is invalid (header should be 'N.SVD5' but is {data[0:6]})")
+                with profiling.span("section parse"):
+                    sections = SectionDirectory(data, n)
+                patchSection = sections.find(PATCH_SECTION)
+                if patchSection == None:
+                    raise SvdError(f"The file '{fileName}' is invalid (section {PATCH_SECTION} not found)")
+                patchStart = patchSection.offset + SECTION_HEADER_SIZE
+                if patchStart + PATCH_COUNT * PATCH_SIZE > n:
+                    raise SvdError(f"The file '{fileName}' is invalid (section {PATCH_SECTION} exceeds the end of the file)")
+            except SvdError:
+                if useMmap:
+                    data.close()
+                raise
+
+            stat = os.stat(fileName)
+            self.close()
+            self.fileName = fileName
+            self.fileStat = (stat.st_size, stat.st_mtime_ns)
+            self.orig = data
+            self.sections = sections
+            self.patchStart = patchStart
+            self.patchEnd = patchStart + PATCH_COUNT * PATCH_SIZE
+            self.patchOffsets = array('l', range(patchStart, self.patchEnd, PATCH_SIZE))
+            self.origHashes = [None] * PATCH_COUNT
+            self.modified = {}
+            self.modifiedHashes = {}
+            self.journal = Journal()
+            self.useMmap = useMmap
+            self.loadCount += 1
+            self.slotVersions = array('L', [0]) * PATCH_COUNT
+
+    def close(self):
+        if isinstance(self.orig, mmap.mmap):
+            try:
+                self.orig.close()
+            except BufferError: # Patches are still referenced, the mapping is closed when they are released
+                pass
+        self.orig = None
+
+    # Saves to a temporary file in the target directory, which is then renamed
+    # over the target, so the existing file stays intact if anything fails. The
+    # temporary file is a copy (a reflink where the file system supports it) of
+    # the loaded file in which only the modified slots are written.
+    def save(self, fileName = None):
+        with profiling.span("save"):
+            if fileName == None:
+                fileName = self.fileName
+
+            directory = os.path.dirname(os.path.abspath(fileName))
+            fd, tempName = tempfile.mkstemp(prefix="." + os.path.basename(fileName) + ".", suffix=".tmp", dir=directory)
+            try:
+                try:
+                    if not self.isUnchangedOnDisk():
+                        raise OSError("file changed since loading")
+                    copyFile(self.fileName, fd)
+                    for index in self.getModifiedSlots():
+                        writeAt(fd, self.modified[index], self.patchOffsets[index])
+                except OSError: # Cannot copy the loaded file, write everything
+                    os.ftruncate(fd, 0)
+                    writeAt(fd, self.orig[0:self.patchStart], 0)
+                    writeAt(fd, self.getPatchArea(), self.patchStart)
+                    writeAt(fd, self.orig[self.patchEnd:], self.patchEnd)
+                os.fsync(fd)
+            except:
+                os.close(fd)
+                os.remove(tempName)
+                raise
+            os.close(fd)
+            try:
+                shutil.copymode(self.fileName, tempName)
+            except OSError:
+                pass
+
+            modified = self.modified
+            modifiedHashes = self.modifiedHashes
+            journal = self.journal
+            if os.name == "nt" and os.path.abspath(fileName) == os.path.abspath(self.fileName):
+                self.close() # Windows does not allow replacing a mapped file
+            try:
+                os.replace(tempName, fileName)
+            except OSError:
+                os.remove(tempName)
+                if self.orig == None:
+                    self.load(self.fileName)
+                    self.modified = modified
+                    self.modifiedHashes = modifiedHashes
+                    self.journal = journal
+                raise
+            syncDirectory(directory)
+            self.load(fileName)
+            self.journal = journal # The deltas hold complete contents, so they remain valid after saving
+
+    def isUnchangedOnDisk(self):
+        try:
+            stat = os.stat(self.fileName)
+        except OSError:
+            return False
+        return (stat.st_size, stat.st_mtime_ns) == self.fileStat
+
+    # The modified slots double as the dirty set: setPatch, setPatchName and the
+    # reverts keep them up to date, so these checks never compare file contents.
+    def isModified(self):
+        return len(self.modified) > 0
+
+    def isPatchModified(self, index):
+        return index in self.modified
+
+    def getModifiedSlots(self):
+        return sorted(self.modified)
+
+    def getSynthName(self):
+        synthName = bytes(self.orig[SYNTH_NAME_OFFSET:SYNTH_NAME_OFFSET + 16])
+        return synthName.decode("UTF-8").strip()
+
+    # Returns MODEL_JD08, MODEL_JX08 or None if the synth name has neither signature
+    def getModel(self):
+        synthName = bytes(self.orig[SYNTH_NAME_OFFSET:SYNTH_NAME_OFFSET + 16])
+        if synthName.startswith(JD_SIG.encode()):
+            return MODEL_JD08
+        if synthName.startswith(JX_SIG.encode()):
+            return MODEL_JX08
+        return None
+
+    def getPatchSectionOffset(self):
+        return self.sections.find(PATCH_SECTION).offset
+
+    def getPatchOffset(self, index):
+        return self.patchOffsets[index]
+
+    def getPatch(self, index):
+        patch = self.modified.get(index)
+        if patch != None:
+            return memoryview(patch)
+        return self.getOriginalPatch(index)
+
+    def getOriginalPatch(self, index):
+        offs = self.getPatchOffset(index)
+        return memoryview(self.orig)[offs:offs + PATCH_SIZE]
+
+    # Returns the patches of all slots as one contiguous buffer
+    def getPatchArea(self):
+        area = memoryview(self.orig)[self.patchStart:self.patchEnd]
+        if len(self.modified) == 0:
+            return area
+        area = bytearray(area)
+        for index, patch in self.modified.items():
+            area[index * PATCH_SIZE:(index + 1) * PATCH_SIZE] = patch
+        return memoryview(area)
+
+    def setPatch(self, index, patch):
+        self.writePatch(index, 0, patch)
+
+    # Replaces (part of) a patch. The stored patch is never changed in place,
+    # so memoryviews returned by getPatch keep their contents.
+    def writePatch(self, index, offset, data):
+        if offset == 0 and len(data) == PATCH_SIZE:
+            # The journal keeps references to the (shared) payloads instead of copies
+            digest, patch = getStore().intern(data)
+            self.journal.record(index, 0, self.getPatchPayload(index), patch)
+            self.storePatch(index, patch, digest)
+            return
+        current = self.getPatch(index)
+        self.journal.record(index, offset, current[offset:offset + len(data)], data)
+        patch = bytearray(current)
+        patch[offset:offset + len(data)] = data
+        self.storePatch(index, bytes(patch))
+
+    def copyPatch(self, toIndex, src, fromIndex):
+        self.setPatch(toIndex, src.getPatch(fromIndex))
+
+    # Sets consecutive slots from a buffer holding one or more patches, as one undo step
+    def setPatches(self, toIndex, data):
+        count = len(data) // PATCH_SIZE
+        if toIndex < 0 or toIndex + count > PATCH_COUNT:
+            raise IndexError(f"Slots {toIndex}..{toIndex + count - 1} out of range")
+        data = memoryview(data)
+        self.journal.beginGroup()
+        for i in range(count):
+            self.setPatch(toIndex + i, data[i * PATCH_SIZE:(i + 1) * PATCH_SIZE])
+        self.journal.endGroup()
+
+    # Copies the patches of src at fromIndices to toIndices (e.g. a whole bank or
+    # an arbitrary selection) as one undo step. Consecutive source ranges are
+    # taken from the patch area of src in one slice.
+    def copyPatches(self, toIndices, src, fromIndices):
+        if len(toIndices) != len(fromIndices):
+            raise ValueError("The number of source and target slots differs")
+        count = len(fromIndices)
+        if count == 0:
+            return
+        if fromIndices == list(range(fromIndices[0], fromIndices[0] + count)) and \
+           toIndices == list(range(toIndices[0], toIndices[0] + count)):
+            self.setPatches(toIndices[0], src.getPatchArea()[fromIndices[0] * PATCH_SIZE:(fromIndices[0] + count) * PATCH_SIZE])
+            return
+        self.journal.beginGroup()
+        for toIndex, fromIndex in zip(toIndices, fromIndices):
+            self.setPatch(toIndex, src.getPatch(fromIndex))
+        self.journal.endGroup()
+
+    def copyBank(self, toBank, src, fromBank):
+        count = PATCH_COUNT // 4
+        self.copyPatches(list(range(toBank * count, (toBank + 1) * count)), src,
+                         list(range(fromBank * count, (fromBank + 1) * count)))
+
+    def revertPatch(self, index):
+        if index in self.modified:
+            self.setPatch(index, self.getOriginalPatch(index))
+
+    def revertPatches(self, indices):
+        self.journal.beginGroup()
+        for index in indices:
+            self.revertPatch(index)
+        self.journal.endGroup()
+
+    def revertAll(self):
+        self.revertPatches(self.getModifiedSlots())
+
+    # Undo and redo return the affected slots, or None if there is nothing to undo/redo
+    def undo(self):
+        step = self.journal.popUndo()
+        if step == None:
+            return None
+        for delta in reversed(step.deltas):
+            self.applyDelta(delta.index, delta.offset, delta.old)
+        return step.slots()
+
+    def redo(self):
+        step = self.journal.popRedo()
+        if step == None:
+            return None
+        for delta in step.deltas:
+            self.applyDelta(delta.index, delta.offset, delta.new)
+        return step.slots()
+
+    def canUndo(self):
+        return self.journal.canUndo()
+
+    def canRedo(self):
+        return self.journal.canRedo()
+
+    def applyDelta(self, index, offset, data):
+        if offset == 0 and len(data) == PATCH_SIZE:
+            self.storePatch(index, data)
+            return
+        patch = bytearray(self.getPatch(index))
+        patch[offset:offset + len(data)] = data
+        self.storePatch(index, bytes(patch))
+
+    def storePatch(self, index, patch, digest = None):
+        if digest == None:
+            digest = hashPatch(patch)
+        if digest == self.getOriginalHash(index):
+            self.modified.pop(index, None)
+            self.modifiedHashes.pop(index, None)
+        else:
+            digest, self.modified[index] = getStore().intern(patch, digest)
+            self.modifiedHashes[index] = digest
+        self.slotVersions[index] += 1
+
+    # Hashes of the patches held in the PatchStore
+    def storedHashes(self):
+        return self.modifiedHashes.values()
+
+    # Returns the patch as bytes, shared with the store for modified slots
+    def getPatchPayload(self, index):
+        patch = self.modified.get(index)
+        if patch != None:
+            return patch
+        return bytes(self.getOriginalPatch(index))
+
+    def getPatchHash(self, index):
+        digest = self.modifiedHashes.get(index)
+        if digest != None:
+            return digest
+        return self.getOriginalHash(index)
+
+    def getOriginalHash(self, index):
+        digest = self.origHashes[index]
+        if digest == None:
+            digest = self.origHashes[index] = hashPatch(self.getOriginalPatch(index))
+        return digest
+
+    def getPatchHashes(self):
+        return [self.getPatchHash(i) for i in range(PATCH_COUNT)]
+
+    def getPatchName(self, index):
+        return self.readPatchName(self.getPatch(index))
+
+    # Label of the slot in the patch lists, slotDiff is the patchdiff.SlotDiff
+    # of the slot when the files are compared
+    def getPatchLabel(self, index, slotDiff = None):
+        label = getPatchNumber(index) + " " + self.getPatchName(index)
+        if self.isPatchModified(index):
+            label += " (was : " + self.getOriginalPatchName(index) + ")"
+        if slotDiff != None:
+            label += f" \u2260 {slotDiff.fieldCount()}"
+            if len(slotDiff.sections) > 0:
+                label += ": " + ", ".join(slotDiff.sections)
+        return label
+
+    def getOriginalPatchName(self, index):
+        return self.readPatchName(self.getOriginalPatch(index))
+
+    def readPatchName(self, patch):
+        patchName = bytes(patch[PATCH_NAME_OFFSET:PATCH_NAME_OFFSET + PATCH_NAME_LENGTH])
+        return patchName.decode("UTF-8").strip()
+
+    # Names longer than 16 bytes are truncated (see encodePatchName), shorter ones padded with spaces
+    def setPatchName(self, index, newName):
+        self.writePatch(index, PATCH_NAME_OFFSET, encodePatchName(newName))
@@ -0,0 +1,124 @@
+#    Copyright (C) 2023 Nils Kronert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    https://github.com/NilsKr/JD08PatchManager
+
+# Generates synthetic .svd files for testing and benchmarking, so no device
+# backup is needed. The files have the N\0SVD5 header, a section directory
+# with a PATa section and 256 patches whose fields (as defined in
+# JD-08.patchdef) hold random but plausible values.
+#
+# Usage: svdgenerator.py <file.svd> [--seed N] [--jx] [--base <file.svd> --changed N]
+
+import argparse
+import os
+import random
+import sys
+from patchlayout import PATCHDEF, getLayout
+from svdfile import (SVD_HEADER, MIN_FILE_SIZE, PATCH_COUNT, PATCH_SIZE, PATCH_NAME_OFFSET,
+                     PATCH_NAME_LENGTH, PATCH_SECTION, SECTION_ENTRY, SECTION_ENTRY_SIZE,
+                     SECTION_HEADER_SIZE, JD_SIG, JX_SIG, SYNTH_NAME_OFFSET, SectionDirectory, SvdError,
+                     padPatchName)
+
+PATCH_SECTION_OFFSET = 0x168260 # As found in device backups
+
+MAX_VALUES = { "uint8_t": 127, "uint16le": 1023 }
+
+NAME_WORDS = [ "Analog", "Bell", "Brass", "Bright", "Choir", "Dark", "Digital", "Glass",
+               "Hollow", "Lead", "Pad", "Piano", "Pluck", "Soft", "Strings", "Sweep",
+               "Warm", "Wave", "Wire", "Vox" ]
+
+def randomName(rng):
+    name = rng.choice(NAME_WORDS) + " " + rng.choice(NAME_WORDS)
+    if rng.random() < 0.3:
+        name += " " + str(rng.randrange(1, 10))
+    return name[:PATCH_NAME_LENGTH]
+
+def randomField(rng, entry):
+    if entry.type == "char":
+        return [bytes(rng.choice(b"abcdefghijklmnopqrstuvwxyz ") for i in range(entry.count))]
+    return [rng.randint(0, MAX_VALUES[entry.type]) for i in range(entry.count)]
+
+def randomPatch(layout, rng, name = None):
+    patch = bytearray(PATCH_SIZE)
+    for entry in layout.fields:
+        entry.decoder.pack_into(patch, entry.offset, *randomField(rng, entry))
+    if name == None:
+        name = randomName(rng)
+    patch[PATCH_NAME_OFFSET:PATCH_NAME_OFFSET + PATCH_NAME_LENGTH] = padPatchName(name).encode("ascii")
+    return patch
+
+# Returns the contents of a new .svd file
+def generateSvd(layout, seed = 0, synthName = JD_SIG):
+    rng = random.Random(seed)
+    data = bytearray(MIN_FILE_SIZE)
+    data[0:len(SVD_HEADER)] = SVD_HEADER
+    SECTION_ENTRY.pack_into(data, SECTION_ENTRY_SIZE, PATCH_SECTION.encode("ascii"), bytes(4),
+                            PATCH_SECTION_OFFSET, SECTION_HEADER_SIZE + PATCH_COUNT * PATCH_SIZE)
+    data[SYNTH_NAME_OFFSET:SYNTH_NAME_OFFSET + len(synthName)] = synthName.encode("ascii")
+    patchStart = PATCH_SECTION_OFFSET + SECTION_HEADER_SIZE
+    for index in range(PATCH_COUNT):
+        offset = patchStart + index * PATCH_SIZE
+        data[offset:offset + PATCH_SIZE] = randomPatch(layout, rng)
+    return data
+
+# Returns a copy of the .svd contents in which a few fields of `changed` random slots differ
+def generateVariant(layout, data, seed = 0, changed = 32, fieldsPerSlot = 4):
+    rng = random.Random(seed)
+    data = bytearray(data)
+    patchSection = SectionDirectory(data, len(data)).find(PATCH_SECTION)
+    if patchSection == None:
+        raise SvdError(f"The base file is invalid (section {PATCH_SECTION} not found)")
+    patchStart = patchSection.offset + SECTION_HEADER_SIZE
+    if patchStart + PATCH_COUNT * PATCH_SIZE > len(data):
+        raise SvdError(f"The base file is invalid (section {PATCH_SECTION} exceeds the end of the file)")
+    numericFields = [e for e in layout.fields if e.type != "char"]
+    for index in rng.sample(range(PATCH_COUNT), changed):
+        offset = patchStart + index * PATCH_SIZE
+        for entry in rng.sample(numericFields, fieldsPerSlot):
+            entry.decoder.pack_into(data, offset + entry.offset, *randomField(rng, entry))
+    return data
+
+def writeSvd(fileName, data):
+    file = open(fileName, 'wb')
+    file.write(data)
+    file.close()
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Generates a synthetic JD-08/JX-08 .svd file")
+    parser.add_argument("fileName")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--jx", action="store_true", help="mark the file as a JX-08 backup")
+    parser.add_argument("--base", help="derive the file from this .svd file instead")
+    parser.add_argument("--changed", type=int, default=32, help="number of slots differing from --base")
+    args = parser.parse_args(argv)
+
+    layout = getLayout(os.path.join(os.path.dirname(os.path.abspath(__file__)), PATCHDEF))
+    if args.base != None:
+        file = open(args.base, 'rb')
+        base = file.read()
+        file.close()
+        try:
+            data = generateVariant(layout, base, args.seed, args.changed)
+        except SvdError as e:
+            print(e)
+            return 1
+    else:
+        data = generateSvd(layout, args.seed, JX_SIG if args.jx else JD_SIG)
+    writeSvd(args.fileName, data)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,64 @@
+#    Copyright (C) 2023 Nils Kronert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    https://github.com/NilsKr/JD08PatchManager
+
+# Tests of the .svd file handling on synthetic files (see svdgenerator.py).
+#
+# Usage: python3 -m unittest test_svdfile.py (or pytest)
+
+import os
+import tempfile
+import unittest
+from patchlayout import PATCHDEF, getLayout
+from svdfile import SvdFile, SvdError, SECTION_ENTRY, SECTION_ENTRY_SIZE, SECTION_HEADER_SIZE
+from svdgenerator import PATCH_SECTION_OFFSET, generateSvd, writeSvd
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+class SectionDirectoryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.fileName = os.path.join(self.directory.name, "test.svd")
+        self.data = generateSvd(getLayout(os.path.join(BASE_DIR, PATCHDEF)), 1)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def load(self):
+        writeSvd(self.fileName, self.data)
+        return SvdFile(self.fileName)
+
+    def testPatchSection(self):
+        svd = self.load()
+        self.assertEqual(svd.getPatchSectionOffset(), PATCH_SECTION_OFFSET)
+
+    # Padding or zero-size entries before PATa are skipped, not the end of the directory
+    def testEntriesBeforePatchSection(self):
+        patEntry = bytes(self.data[SECTION_ENTRY_SIZE:2 * SECTION_ENTRY_SIZE])
+        self.data[SECTION_ENTRY_SIZE:2 * SECTION_ENTRY_SIZE] = bytes(SECTION_ENTRY_SIZE) # Padding
+        SECTION_ENTRY.pack_into(self.data, 2 * SECTION_ENTRY_SIZE, b"EMPT", bytes(4), 0, 0) # Zero size, no offset
+        self.data[3 * SECTION_ENTRY_SIZE:4 * SECTION_ENTRY_SIZE] = patEntry
+        svd = self.load()
+        self.assertEqual(svd.getPatchSectionOffset(), PATCH_SECTION_OFFSET)
+        self.assertEqual(svd.patchStart, PATCH_SECTION_OFFSET + SECTION_HEADER_SIZE)
+
+    def testMissingPatchSection(self):
+        self.data[SECTION_ENTRY_SIZE:2 * SECTION_ENTRY_SIZE] = bytes(SECTION_ENTRY_SIZE)
+        with self.assertRaises(SvdError):
+            self.load()
+
+if __name__ == "__main__":
+    unittest.main()